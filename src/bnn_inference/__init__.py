@@ -1,5 +1,16 @@
+import importlib
+
 # Toolkit
-from bnn_inference.tools.bnn_model import BayesianRegressor  # noqa: F401
 from bnn_inference.tools.console import Console  # noqa: F401
 from bnn_inference.tools.dataloader import CustomDataloader  # noqa: F401
 from bnn_inference.tools.predictor import PredictiveEngine  # noqa: F401
+
+
+def __getattr__(name):
+    # BayesianRegressor (blitz) is imported on first access, so that the scripted
+    # predict backend does not need to load it
+    if name == "BayesianRegressor":
+        return importlib.import_module(
+            "bnn_inference.tools.bnn_model"
+        ).BayesianRegressor
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
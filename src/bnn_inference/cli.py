@@ -1,12 +1,16 @@
 import os
+from typing import List
 
 import typer
 import yaml
 
+from bnn_inference.convert import convert_impl
+from bnn_inference.export import export_impl
 from bnn_inference.join_predictions import join_predictions_impl
 from bnn_inference.predict import predict_impl
+from bnn_inference.serve import serve_impl
 from bnn_inference.tools.console import Console
-from bnn_inference.train import train_impl
+from bnn_inference.uncertainty_report import uncertainty_report_impl
 
 app = typer.Typer(
     add_completion=False, context_settings={"help_option_names": ["-h", "--help"]}
@@ -118,7 +122,76 @@ def train(
         help="If set, the training will be performed on the CPU. This is useful for "
         "debugging purposes and low-spec computers.",
     ),
+    dataset_cache: str = typer.Option(
+        "",
+        help="Optional directory caching the joined training dataset. Later runs on "
+        "the same input/target files and keys skip the parsing and the join. The "
+        "cache is rebuilt when the files change. Default: '' (disabled)",
+    ),
+    kl_method: str = typer.Option(
+        "mc",
+        help="KL divergence (complexity cost) of the ELBO: 'mc' estimates it from the "
+        "sampled weights, 'analytic' uses the closed-form Gaussian KL divergence "
+        "(lower gradient variance, computed once per step)",
+    ),
+    bayesian_layer: str = typer.Option(
+        "blitz",
+        help="Bayesian layer of the network: 'blitz' samples one weight matrix per "
+        "forward pass, 'local' uses the local reparameterisation trick (pre-activations "
+        "sampled per example, lower variance gradients). Both share the same "
+        "parameters, so the trained networks can be used in the same way",
+    ),
+    batch_size: int = typer.Option(8, help="Number of input entries per mini-batch"),
+    lr_scaling: str = typer.Option(
+        "none",
+        help="Learning rate scaling rule for batch sizes other than 8: 'none', "
+        "'linear' (lr x batch_size / 8) or 'sqrt' (lr x sqrt(batch_size / 8))",
+    ),
+    valid_every: int = typer.Option(
+        1, help="Validate every N epochs (the last epoch is always validated)"
+    ),
+    valid_samples: int = typer.Option(
+        0,
+        help="Number of Monte Carlo samples for the validation loss. Default: 0 (same "
+        "as --num-samples)",
+    ),
+    patience: int = typer.Option(
+        0,
+        help="Early stopping: stop after this number of epochs without improvement of "
+        "the validation loss, and keep the best network. Default: 0 (disabled)",
+    ),
+    min_delta: float = typer.Option(
+        0.0,
+        help="Early stopping: minimum decrease of the validation loss considered an "
+        "improvement",
+    ),
+    checkpoint_every: int = typer.Option(
+        0,
+        help="Save a checkpoint (network, optimizer, RNG state and loss history) every "
+        "N epochs, next to the output network (<network>.ckpt). It is also saved when "
+        "the training is interrupted (Ctrl-C, SIGTERM). Default: 0 (disabled)",
+    ),
+    resume: bool = typer.Option(
+        False,
+        help="Continue the training from the last checkpoint of the output network",
+    ),
+    precision: str = typer.Option(
+        "float32",
+        help="Precision of the forward pass and ELBO: 'float32' or 'bfloat16' "
+        "(autocast, faster on CPUs with bf16 support). The weight sampling and the "
+        "KL divergence stay in float32. The accuracy against float32 is reported",
+    ),
+    torch_compile: bool = typer.Option(
+        False,
+        "--compile",
+        help="Compile the training step (forward passes and ELBO) with torch.compile. "
+        "Runs in eager mode if compilation is unavailable. The compilation and "
+        "steady-state step times are reported",
+    ),
 ):
+    # The training stack (blitz, sklearn) is only imported when training
+    from bnn_inference.train import train_impl
+
     Console.info("Training")
     if config == "":
         Console.info("Using command line arguments only.")
@@ -142,6 +215,133 @@ def train(
         loss_method=loss_method,
         gpu_index=gpu_index,
         cpu_only=cpu_only,
+        dataset_cache=dataset_cache,
+        kl_method=kl_method,
+        bayesian_layer=bayesian_layer,
+        batch_size=batch_size,
+        lr_scaling=lr_scaling,
+        valid_every=valid_every,
+        valid_samples=valid_samples,
+        patience=patience,
+        min_delta=min_delta,
+        checkpoint_every=checkpoint_every,
+        resume=resume,
+        precision=precision,
+        torch_compile=torch_compile,
+    )
+
+
+@app.command()
+def sweep(
+    config: str = typer.Option(
+        "",
+        help="Path to a YAML configuration file. You can use the file exclusively or "
+        "overwrite any arguments via CLI.",
+        callback=config_cb,
+        is_eager=True,
+    ),
+    latent_csv: str = typer.Option(
+        ...,
+        help="Path to CSV containing the latent representation vector for each input "
+        "entry (image). The 'UUID' is used to match against the target file entries",
+    ),
+    latent_key: str = typer.Option(
+        "latent_",
+        help="Name of the key used for the columns containing the latent vector. For "
+        "example, a h=8 vector should be read as 'latent_0,latent_1,...,latent_7'",
+    ),
+    target_csv: str = typer.Option(
+        ...,
+        help="Path to CSV containing the target entries to be used for "
+        "training/validation. The 'UUID' is used to match against the input file entries",
+    ),
+    target_key: str = typer.Option(
+        ...,
+        help="Keyword that defines the field to be learnt/predicted. It must match the "
+        "column name in the target file",
+    ),
+    uuid_key: str = typer.Option(
+        "relative_path",
+        help="Unique identifier string used as key for input/target example matching. "
+        "The UUID string must match for both the input (latent) file and the target "
+        "file column identifier",
+    ),
+    search_space: str = typer.Option(
+        ...,
+        help="YAML file with the search space: method ('grid' or 'random'), "
+        "num_trials (random search), parameters (train options and their values or "
+        "ranges) and fixed (train options shared by all the trials)",
+    ),
+    output_dir: str = typer.Option(
+        "sweep",
+        help="Output directory: one sub-directory per trial (network, predictions and "
+        "logs) and the results table (sweep_results.csv)",
+    ),
+    num_epochs: int = typer.Option(
+        100,
+        help="Number of training epochs of each trial (maximum budget with successive "
+        "halving)",
+    ),
+    min_epochs: int = typer.Option(
+        0,
+        help="Successive halving: epochs of the first rung. Only the best "
+        "1/--reduction-factor trials of each rung continue training, with "
+        "--reduction-factor times more epochs. Default: 0 (disabled)",
+    ),
+    reduction_factor: int = typer.Option(
+        3, help="Successive halving: fraction of trials kept and epoch growth per rung"
+    ),
+    metric: str = typer.Option(
+        "valid_rmse",
+        help="Metric used to rank the trials: 'valid_rmse', 'valid_nll' or "
+        "'valid_loss' (ELBO, only comparable for the same lambda values)",
+    ),
+    workers: int = typer.Option(1, help="Number of trials trained concurrently"),
+    threads_per_trial: int = typer.Option(
+        0,
+        help="Number of intra-op threads used by each trial. Default: 0 (number of CPU "
+        "cores divided by the number of workers)",
+    ),
+    seed: int = typer.Option(
+        0,
+        help="Random seed of the random search and of the trials (all the trials use "
+        "the same train/validation split)",
+    ),
+    gpu_index: int = typer.Option(0, help="Index of CUDA device to be used."),
+    cpu_only: bool = typer.Option(
+        False,
+        help="If set, the training will be performed on the CPU.",
+    ),
+    dataset_cache: str = typer.Option(
+        "",
+        help="Optional directory caching the joined training dataset (see train). "
+        "Default: '' (disabled)",
+    ),
+):
+    # The training stack (blitz, sklearn) is only imported when training
+    from bnn_inference.sweep import sweep_impl
+
+    Console.info("Sweep")
+    if config == "":
+        Console.info("Using command line arguments only.")
+    sweep_impl(
+        latent_csv=latent_csv,
+        latent_key=latent_key,
+        target_csv=target_csv,
+        target_key=target_key,
+        uuid_key=uuid_key,
+        search_space=search_space,
+        output_dir=output_dir,
+        num_epochs=num_epochs,
+        min_epochs=min_epochs,
+        reduction_factor=reduction_factor,
+        metric=metric,
+        workers=workers,
+        threads_per_trial=threads_per_trial,
+        seed=seed,
+        dataset_cache=dataset_cache,
+        gpu_index=gpu_index,
+        cpu_only=cpu_only,
     )
 
 
@@ -194,6 +394,83 @@ def predict(
         help="If set, the training will be performed on the CPU. This is useful for "
         "debugging purposes.",
     ),
+    block_size: int = typer.Option(
+        4096,
+        help="Number of input rows evaluated together for each posterior sample. "
+        "Larger blocks are faster but use more memory",
+    ),
+    chunk_size: int = typer.Option(
+        0,
+        help="If larger than zero, the latent file is read, predicted and exported in "
+        "chunks of this number of rows (streaming mode), so the memory usage is "
+        "bounded by the chunk size rather than the file size. Default: 0 (disabled)",
+    ),
+    workers: int = typer.Option(
+        1,
+        help="Number of CPU worker processes used for prediction. The input rows are "
+        "split across the workers and reassembled in the original order",
+    ),
+    threads_per_worker: int = typer.Option(
+        0,
+        help="Number of intra-op threads used by each worker process. Default: 0 "
+        "(number of CPU cores divided by the number of workers)",
+    ),
+    uncertainty_mode: str = typer.Option(
+        "mc",
+        help="Posterior estimation method: 'mc' (Monte Carlo sampling, --num-samples "
+        "per row), 'moments' (single deterministic pass using moment propagation, "
+        "linear output layer only) or 'bank' (--num-samples weight samples drawn once "
+        "and shared by all rows, reproducible with --seed) or 'adaptive' (at least "
+        "--num-samples and at most --max-samples per row, until the mean and std "
+        "converge within --tolerance)",
+    ),
+    seed: int = typer.Option(
+        0, help="Random seed used to draw the weight-sample bank ('bank' mode)"
+    ),
+    weight_bank: str = typer.Option(
+        "",
+        help="Optional file to store the weight-sample bank ('bank' mode). If it "
+        "exists and matches the network, --num-samples and --seed, it is reused",
+    ),
+    max_samples: int = typer.Option(
+        100, help="Maximum number of samples per row ('adaptive' mode)"
+    ),
+    tolerance: float = typer.Option(
+        0.01,
+        help="Convergence tolerance ('adaptive' mode): a row stops sampling once the "
+        "standard error of its predicted mean and std are below this value, in "
+        "output units (after --scale-factor)",
+    ),
+    backend: str = typer.Option(
+        "torch",
+        help="Prediction backend: 'torch' (trained network dictionary) or 'script' "
+        "(predictor exported with the export command, faster start-up). The script "
+        "backend supports the 'mc' and 'adaptive' uncertainty modes",
+    ),
+    cache: str = typer.Option(
+        "",
+        help="Optional on-disk prediction cache (SQLite file). Rows already predicted "
+        "with the same network, settings and latent vector are read from the cache "
+        "instead of being predicted again. Default: '' (disabled)",
+    ),
+    cache_size_mb: float = typer.Option(
+        1024,
+        help="Maximum size of the prediction cache (MB). The least recently used "
+        "entries are evicted above this size",
+    ),
+    precision: str = typer.Option(
+        "float32",
+        help="Precision of the forward pass: 'float32' or 'bfloat16' (autocast, faster "
+        "on CPUs with bf16 support, not used by the 'moments' mode). The accuracy "
+        "against float32 is reported on the first block of rows",
+    ),
+    torch_compile: bool = typer.Option(
+        False,
+        "--compile",
+        help="Compile the batched sampling predictor ('mc' and 'bank' modes, torch "
+        "backend) with torch.compile. Runs in eager mode if compilation is "
+        "unavailable. The compilation and steady-state times are reported",
+    ),
 ):
     Console.info("Predicting")
     if config == "":
@@ -209,6 +486,159 @@ def predict(
         scale_factor=scale_factor,
         gpu_index=gpu_index,
         cpu_only=cpu_only,
+        block_size=block_size,
+        chunk_size=chunk_size,
+        workers=workers,
+        threads_per_worker=threads_per_worker,
+        uncertainty_mode=uncertainty_mode,
+        seed=seed,
+        weight_bank=weight_bank,
+        max_samples=max_samples,
+        tolerance=tolerance,
+        backend=backend,
+        cache_filename=cache,
+        cache_size_mb=cache_size_mb,
+        precision=precision,
+        torch_compile=torch_compile,
+    )
+
+
+@app.command()
+def convert(
+    config: str = typer.Option(
+        "",
+        help="Path to a YAML configuration file. You can use the file exclusively or "
+        "overwrite any arguments via CLI.",
+        callback=config_cb,
+        is_eager=True,
+    ),
+    latent_csv: str = typer.Option(
+        ...,
+        help="Path to CSV (or Parquet/Arrow) file containing the latent representation "
+        "vector for each input entry (image)",
+    ),
+    latent_key: str = typer.Option(
+        "latent_",
+        help="Name of the key used for the columns containing the latent vector. For "
+        "example, a h=8 vector should be read as 'latent_0,latent_1,...,latent_7'",
+    ),
+    output_store: str = typer.Option(
+        "",
+        help="Output latent store (directory). It can be used instead of the latent "
+        "file by predict and train. Default: <latent_csv>.latents",
+    ),
+):
+    Console.info("Converting")
+    convert_impl(
+        latent_csv=latent_csv, latent_key=latent_key, output_store=output_store
+    )
+
+
+@app.command()
+def export(
+    config: str = typer.Option(
+        "",
+        help="Path to a YAML configuration file. You can use the file exclusively or "
+        "overwrite any arguments via CLI.",
+        callback=config_cb,
+        is_eager=True,
+    ),
+    output_network_filename: str = typer.Option(
+        ..., help="Trained Bayesian Neural Network in PyTorch compatible format."
+    ),
+    output_layer_type: str = typer.Option(
+        "linear",
+        help="Output layer type: 'linear', 'softmax', 'softmin'",
+    ),
+    output_filename: str = typer.Option(
+        "",
+        help="Exported predictor file. Default: <network>.script.pt (or .onnx)",
+    ),
+    export_format: str = typer.Option(
+        "script",
+        help="Export format: 'script' (TorchScript, can be used with predict "
+        "--backend script) or 'onnx' (graph with the weight noise as inputs, requires "
+        "the onnx package)",
+    ),
+):
+    Console.info("Exporting")
+    export_impl(
+        output_network_filename=output_network_filename,
+        output_layer_type=output_layer_type,
+        output_filename=output_filename,
+        export_format=export_format,
+    )
+
+
+@app.command()
+def serve(
+    config: str = typer.Option(
+        "",
+        help="Path to a YAML configuration file. You can use the file exclusively or "
+        "overwrite any arguments via CLI.",
+        callback=config_cb,
+        is_eager=True,
+    ),
+    network: List[str] = typer.Option(
+        ...,
+        help="Network to keep resident, as 'name=path' or 'path' (named after the "
+        "file). Can be repeated. Files ending in .script.pt are loaded as exported "
+        "predictors (see export)",
+    ),
+    output_layer_type: str = typer.Option(
+        "linear",
+        help="Output layer type: 'linear', 'softmax', 'softmin'",
+    ),
+    host: str = typer.Option("127.0.0.1", help="HTTP address to listen on"),
+    port: int = typer.Option(8080, help="HTTP port to listen on"),
+    socket_path: str = typer.Option(
+        "",
+        help="If set, listen on this unix socket instead of the HTTP address and port",
+    ),
+    num_samples: int = typer.Option(
+        10,
+        help="Number of Monte Carlo samples for ELBO based posterior estimation",
+    ),
+    scale_factor: float = typer.Option(
+        1.0, help="Output scaling factor. Default: 1.0 (no scaling))"
+    ),
+    uncertainty_mode: str = typer.Option(
+        "mc",
+        help="Posterior estimation method: 'mc' (Monte Carlo sampling) or 'moments' "
+        "(moment propagation, linear output layer only)",
+    ),
+    block_size: int = typer.Option(
+        4096,
+        help="Number of input rows evaluated together for each posterior sample",
+    ),
+    max_batch_rows: int = typer.Option(
+        4096,
+        help="Concurrent requests are coalesced into micro-batches of up to this "
+        "number of rows",
+    ),
+    max_delay_ms: float = typer.Option(
+        5.0,
+        help="Latency budget: maximum time (ms) a request waits for other requests "
+        "to join its micro-batch",
+    ),
+    num_threads: int = typer.Option(
+        0, help="Number of intra-op CPU threads. Default: 0 (PyTorch default)"
+    ),
+):
+    Console.info("Serving")
+    serve_impl(
+        networks=network,
+        output_layer_type=output_layer_type,
+        host=host,
+        port=port,
+        socket_path=socket_path,
+        num_samples=num_samples,
+        scale_factor=scale_factor,
+        uncertainty_mode=uncertainty_mode,
+        block_size=block_size,
+        max_batch_rows=max_batch_rows,
+        max_delay_ms=max_delay_ms,
+        num_threads=num_threads,
     )
 
 
@@ -246,6 +676,62 @@ def join_predictions(
     join_predictions_impl(latent_csv, target_csv, target_key, output_csv)
 
 
+@app.command("uncertainty_report")
+def uncertainty_report(
+    config: str = typer.Option(
+        "",
+        help="Path to a YAML configuration file. You can use the file exclusively or "
+        "overwrite any arguments via CLI.",
+        callback=config_cb,
+        is_eager=True,
+    ),
+    latent_csv: str = typer.Option(
+        ...,
+        help="Path to CSV containing the latent representation vector for each input "
+        "entry (image), e.g. a validation file",
+    ),
+    latent_key: str = typer.Option(
+        "latent_",
+        help="Name of the key used for the columns containing the latent vector. For "
+        "example, a h=8 vector should be read as 'latent_0,latent_1,...,latent_7'",
+    ),
+    output_network_filename: str = typer.Option(
+        ..., help="Trained Bayesian Neural Network in PyTorch compatible format."
+    ),
+    num_samples: int = typer.Option(
+        100,
+        help="Number of Monte Carlo samples used as reference for the comparison",
+    ),
+    scale_factor: float = typer.Option(
+        1.0, help="Output scaling factor. Default: 1.0 (no scaling))"
+    ),
+    block_size: int = typer.Option(
+        4096, help="Number of input rows evaluated together for each forward pass"
+    ),
+    output_filename: str = typer.Option(
+        "",
+        help="Output YAML report. Default: <latent_csv>.uncertainty_report.yaml",
+    ),
+    gpu_index: int = typer.Option(0, help="Index of CUDA device to be used."),
+    cpu_only: bool = typer.Option(
+        False,
+        help="If set, the report will be computed on the CPU.",
+    ),
+):
+    Console.info("Uncertainty report")
+    uncertainty_report_impl(
+        latent_csv=latent_csv,
+        latent_key=latent_key,
+        output_network_filename=output_network_filename,
+        num_samples=num_samples,
+        scale_factor=scale_factor,
+        block_size=block_size,
+        output_filename=output_filename,
+        gpu_index=gpu_index,
+        cpu_only=cpu_only,
+    )
+
+
 def main(args=None):
     # enable VT100 Escape Sequence for WINDOWS 10 for Console outputs
     # https://stackoverflow.com/questions/16755142/how-to-make-win32-console-recognize-ansi-vt100-escape-sequences
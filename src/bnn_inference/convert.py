@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import os
+
+from bnn_inference.tools.console import Console
+from bnn_inference.tools.latent_store import convert_latents, is_latent_store
+
+
+def convert_impl(latent_csv, latent_key, output_store):
+    Console.info(
+        "Converting latent file into a memory-mapped binary store (float32 latents)"
+    )
+    if not os.path.isfile(latent_csv):
+        Console.quit("Latent input file not found: ", latent_csv)
+    if output_store == "":
+        output_store = os.path.splitext(latent_csv)[0] + ".latents"
+    if is_latent_store(output_store):
+        Console.warn(
+            "Latent store [",
+            output_store,
+            "] already exists. It will be overwritten (default action)",
+        )
+    elif os.path.exists(output_store):
+        Console.quit("Output path exists and is not a latent store: ", output_store)
+
+    manifest = convert_latents(latent_csv, latent_key, output_store)
+    Console.info(
+        "Stored",
+        manifest["num_rows"],
+        "rows x",
+        len(manifest["latent_columns"]),
+        "latents (",
+        manifest["num_dropped_rows"],
+        "invalid rows removed) in: ",
+        output_store,
+    )
+    Console.info("Done!")
+    return 0
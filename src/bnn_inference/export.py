@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import os
+from datetime import datetime
+
+import torch
+
+from bnn_inference.tools.console import Console
+from bnn_inference.tools.predictor import PredictiveEngine
+from bnn_inference.tools.scripted_predictor import (
+    PosteriorPredictor,
+    export_onnx,
+    export_scripted,
+)
+
+
+def export_impl(
+    output_network_filename, output_layer_type, output_filename, export_format
+):
+    Console.info(
+        "Exporting the posterior predictor of a trained network for fast-start inference"
+    )
+    if not os.path.isfile(output_network_filename):
+        Console.quit("No pre-trained network found at: ", output_network_filename)
+    if export_format not in ["script", "onnx"]:
+        Console.quit("Unknown export format: ", export_format)
+    if output_filename == "":
+        extension = ".onnx" if export_format == "onnx" else ".script.pt"
+        output_filename = os.path.splitext(output_network_filename)[0] + extension
+
+    regressor, trained_network = PredictiveEngine.loadNetwork(
+        output_network_filename, None, output_layer_type, torch.device("cpu")
+    )
+    predictor = PosteriorPredictor(regressor, output_type=output_layer_type).eval()
+
+    # Sanity check: with no weight noise, both networks use the posterior mean
+    x = torch.randn((8, regressor.linear_input.in_features))
+    blinear = regressor.blinear1
+    with torch.inference_mode():
+        blinear.freeze = True
+        expected = regressor(x)
+        blinear.freeze = False
+        predicted = predictor(
+            x,
+            torch.zeros((1,) + tuple(blinear.weight_mu.shape)),
+            torch.zeros((1,) + tuple(blinear.bias_mu.shape)),
+        )[0]
+    if not torch.allclose(expected, predicted, atol=1e-5):
+        Console.quit("The exported predictor does not match the trained network")
+
+    metadata = {
+        "input_dim": regressor.linear_input.in_features,
+        "output_dim": regressor.linear_output.out_features,
+        "output_type": output_layer_type,
+        "network_filename": output_network_filename,
+        "export_date": datetime.now().isoformat(timespec="seconds"),
+    }
+    for key in ["epochs", "batch_size", "learning_rate", "lambda_fit_loss", "elbo_kld"]:
+        if key in trained_network:
+            metadata[key] = trained_network[key]
+
+    Console.info("Exporting", export_format, "predictor to: ", output_filename)
+    if export_format == "onnx":
+        try:
+            export_onnx(predictor, output_filename, metadata)
+        except Exception as ex:  # e.g. the onnx package is not installed
+            Console.quit("ONNX export failed:", ex)
+        Console.info("Metadata exported to: ", output_filename + ".json")
+    else:
+        export_scripted(predictor, output_filename, metadata)
+    Console.info("Done!")
+    return 0
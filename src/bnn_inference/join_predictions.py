@@ -3,6 +3,7 @@ import os
 import pandas as pd
 
 from bnn_inference.tools.console import Console
+from bnn_inference.tools.table_io import read_table, write_table
 
 
 def join_predictions_impl(latent_csv, target_csv, target_key, output_csv):
@@ -61,8 +62,9 @@ def join_predictions_impl(latent_csv, target_csv, target_key, output_csv):
         )
         return -1
 
-    df1 = pd.read_csv(target_csv, index_col=0)  # <------- ground truth
-    df2 = pd.read_csv(latent_csv, index_col=0)  # <------- predictions
+    df1 = read_table(target_csv, index_col=0)  # <------- ground truth
+    # all the columns are read: rows with NaN in any of them are dropped below
+    df2 = read_table(latent_csv, index_col=0)  # <------- predictions
 
     df1 = df1.dropna()
     df2 = df2.dropna()
@@ -90,5 +92,5 @@ def join_predictions_impl(latent_csv, target_csv, target_key, output_csv):
     merged_df = pd.merge(df1, dfx, on="uuid", how="inner")
     Console.info("Exporting merged dataframes to ", output_csv)
     merged_df.index.names = ["index"]
-    merged_df.to_csv(output_csv)
+    write_table(merged_df, output_csv)
     Console.info("... done!")
@@ -12,12 +12,12 @@ from datetime import datetime
 
 import numpy as np
 import pandas as pd
-import torch
 
-from bnn_inference.tools.bnn_model import BayesianRegressor
 from bnn_inference.tools.console import Console
-from bnn_inference.tools.predictor import PredictiveEngine
-from bnn_inference.train import get_torch_device
+from bnn_inference.tools.prediction_cache import PredictionCache
+from bnn_inference.tools.predictor import PredictionPool, PredictiveEngine
+from bnn_inference.tools.table_io import TableWriter
+from bnn_inference.tools.utilities import check_precision, get_torch_device
 
 
 def predict_impl(
@@ -31,6 +31,20 @@ def predict_impl(
     scale_factor,
     gpu_index,
     cpu_only,
+    block_size=4096,
+    chunk_size=0,
+    workers=1,
+    threads_per_worker=0,
+    uncertainty_mode="mc",
+    seed=0,
+    weight_bank="",
+    max_samples=100,
+    tolerance=0.01,
+    backend="torch",
+    cache_filename="",
+    cache_size_mb=1024,
+    precision="float32",
+    torch_compile=False,
 ):
     Console.info(
         "Bayesian NN inference module. Predicting hi-res terrain maps from lo-res features"
@@ -41,7 +55,7 @@ def predict_impl(
         "Prediction mode enabled. Looking for pretained network and input latent vectors"
     )
     # Looking for CSV with latent vectors (input)
-    if os.path.isfile(latent_csv):
+    if os.path.exists(latent_csv):  # file or latent store (see convert)
         Console.info("Latent input file: ", latent_csv)
     else:
         Console.error(
@@ -90,136 +104,307 @@ def predict_impl(
         scaling_factor = scale_factor
     else:
         scaling_factor = 1.0
+    # 'mc': Monte Carlo posterior sampling, 'moments': sampling-free moment propagation
+    # 'bank': the same K posterior weight samples are used for every row (reproducible)
+    # 'adaptive': each row is sampled until its mean and std converge (up to max_samples)
+    if uncertainty_mode == "moments":
+        if output_layer_type != "linear":
+            Console.quit("Moment propagation requires a linear output layer")
+        Console.info("Using moment propagation (no posterior sampling)")
+    elif uncertainty_mode == "adaptive":
+        if max_samples < k_samples:
+            Console.warn(
+                "Max samples lower than the number of samples, using", k_samples
+            )
+            max_samples = k_samples
+        Console.info(
+            "Adaptive sampling: between",
+            k_samples,
+            "and",
+            max_samples,
+            "samples per row",
+        )
+    elif uncertainty_mode not in ["mc", "bank"]:
+        Console.quit("Unknown uncertainty mode: ", uncertainty_mode)
+    # 'torch': trained network dictionary, 'script': predictor exported with export
+    if backend == "script":
+        if uncertainty_mode not in ["mc", "adaptive"]:
+            Console.quit(
+                "The script backend supports the 'mc' and 'adaptive' modes only"
+            )
+    elif backend != "torch":
+        Console.quit("Unknown backend: ", backend)
+    check_precision(precision)
+    if precision != "float32":
+        if uncertainty_mode == "moments":
+            Console.warn("Moment propagation always runs in float32")
+            precision = "float32"
+        else:
+            Console.info("Using", precision, "autocast for the forward pass")
+    if torch_compile:
+        if backend == "script":
+            Console.warn("The script backend is already compiled, ignoring --compile")
+            torch_compile = False
+        elif uncertainty_mode not in ["mc", "bank"]:
+            Console.warn("--compile is only used by the 'mc' and 'bank' modes")
+            torch_compile = False
 
     Console.info("Loading latent input [", latent_csv, "]")
-    np_latent, n_latents, df = PredictiveEngine.loadData(
-        latent_csv, input_key_prefix="latent_"
-    )
-
-    Console.info("Loading pretrained network [", output_network_filename, "]")
-    device = get_torch_device(gpu_index, cpu_only)
-
-    if torch.cuda.is_available():
-        Console.info("Using CUDA")
-        trained_network = torch.load(
-            output_network_filename
-        )  # load pretrained model (dictionary)
-        # we need to determine the number of outputs by looking at the linear_output layer
-        output_size = len(
-            trained_network["model_state_dict"]["linear_output.weight"]
-            .data.cpu()
-            .numpy()
+    if chunk_size > 0:
+        # Streaming mode: the input is read, predicted and exported chunk_size rows
+        # at a time, so the memory footprint is bounded by the chunk size
+        Console.info("Streaming prediction enabled. Chunk size: ", chunk_size)
+        chunks = PredictiveEngine.iterData(
+            latent_csv, input_key_prefix=input_key, chunk_size=chunk_size
         )
-        regressor = BayesianRegressor(
-            input_dim=n_latents, output_dim=output_size, output_type=output_layer_type
-        ).to(device)
     else:
-        Console.warn("Using CPU")
-        trained_network = torch.load(
-            output_network_filename, map_location=torch.device("cpu")
-        )  # load pretrained model (dictionary)
-        output_size = len(
-            trained_network["model_state_dict"]["linear_output.weight"]
-            .data.cpu()
-            .numpy()
+        chunks = [PredictiveEngine.loadData(latent_csv, input_key_prefix=input_key)]
+
+    device = get_torch_device(gpu_index, cpu_only)
+    if workers > 1 and device.type != "cpu":
+        Console.warn("Multi-process prediction (--workers) runs on the CPU only")
+    regressor = None
+    bank = None  # weight-sample bank, only for the 'bank' uncertainty mode
+    pool = None  # pool of worker processes, only when workers > 1
+    cache = None  # prediction cache, only when cache_filename is provided
+    compiled = []  # compiled sampling functions, only when torch_compile is set
+    writer = TableWriter(output_csv)
+    n_rows = 0  # number of rows exported so far, used to index the output rows
+    for np_latent, n_latents, df in chunks:
+        if regressor is None:
+            # The network is built once we know the dimension of the latent vector
+            if backend == "script":
+                Console.info(
+                    "Loading exported predictor [", output_network_filename, "]"
+                )
+                regressor, metadata = PredictiveEngine.loadScripted(
+                    output_network_filename, n_latents, device
+                )
+                output_layer_type = metadata["output_type"]
+                print("Exported predictor metadata ||")
+                for key, value in metadata.items():
+                    print("\t" + key + ": ", value)
+            else:
+                Console.info(
+                    "Loading pretrained network [", output_network_filename, "]"
+                )
+                regressor, trained_network = PredictiveEngine.loadNetwork(
+                    output_network_filename, n_latents, output_layer_type, device
+                )
+                # Show information about the model dictionary
+                # Model dictionary contains:
+                # model_dict = {'epochs': num_epochs,
+                #               'batch_size': data_batch_size,
+                #               'learning_rate': learning_rate,
+                #               'lambda_fit_loss': lambda_fit_loss,
+                #               'elbo_kld': elbo_kld,
+                #               'model_state_dict': regressor.state_dict()}
+                print(
+                    "Model dictionary loaded network ||"
+                )  # For each key in the dictionary, we can check if defined and show warning if not
+                print("\tEpochs: ", trained_network["epochs"])
+                print("\tBatch size: ", trained_network["batch_size"])
+                print("\tLearning rate: ", trained_network["learning_rate"])
+                print("\tLambda fit loss: ", trained_network["lambda_fit_loss"])
+                print("\tELBO k-samples: ", trained_network["elbo_kld"])
+                if torch_compile:
+                    Console.info("Compiling the sampling predictor (torch.compile)")
+                    compiled = PredictiveEngine.compileSampling(regressor)
+            if uncertainty_mode == "bank":
+                bank = PredictiveEngine.loadWeightBank(
+                    regressor, k_samples, seed=seed, bank_filename=weight_bank
+                )
+            if workers > 1:
+                pool = PredictionPool(
+                    output_network_filename,
+                    n_latents,
+                    output_layer_type,
+                    workers,
+                    threads_per_worker=threads_per_worker,
+                    backend=backend,
+                    torch_compile=torch_compile,
+                )
+            if cache_filename:
+                # Rows predicted by a previous run (same network, settings and latent
+                # vector) are read from the cache instead of being predicted again
+                Console.info("Using prediction cache [", cache_filename, "]")
+                cache = PredictionCache(
+                    cache_filename,
+                    output_network_filename,
+                    {
+                        "output_layer_type": output_layer_type,
+                        "backend": backend,
+                        "uncertainty_mode": uncertainty_mode,
+                        "num_samples": k_samples,
+                        "seed": seed if uncertainty_mode == "bank" else None,
+                        "max_samples": max_samples,
+                        "tolerance": tolerance / scaling_factor,
+                        "precision": precision,
+                    },
+                    max_size_mb=cache_size_mb,
+                )
+
+        # Apply any pre-existing scaling factor to the input
+        X_norm = np_latent  # for large latents, input to the network
+        if chunk_size <= 0:
+            print("X_norm [min,max]", np.amin(X_norm), "/", np.amax(X_norm))
+        if precision != "float32" and n_rows == 0:
+            # Accuracy of the reduced precision against float32, on the first block
+            mean_delta, stdv_delta = PredictiveEngine.precisionDelta(
+                regressor,
+                X_norm[:block_size],
+                k_samples,
+                precision,
+                device=device,
+                uncertainty_mode=uncertainty_mode,
+                bank=bank,
+                max_samples=max_samples,
+                tolerance=tolerance / scaling_factor,
+            )
+            Console.info(
+                precision,
+                "vs float32, max abs. difference on the first",
+                min(block_size, len(X_norm)),
+                "rows | mean: {:.2e}, std: {:.2e}".format(
+                    mean_delta * scaling_factor, stdv_delta * scaling_factor
+                ),
+            )
+
+        # Then, check the dataframe which should contain the same ordered rows from the latent space (see final step of training/validation)
+        ####################################################################
+
+        # Network is pretrained so we start inferring
+        # For every input (row) we draw a K samples from the posterior, block_size rows at a time
+        if cache is not None:
+            keys = cache.rowKeys(X_norm)
+            cached, predicted, uncertainty, n_samples = cache.lookup(
+                keys, regressor.linear_output.out_features
+            )
+            X_new = X_norm[~cached]
+        else:
+            X_new = X_norm
+        if pool is not None:
+            new_predicted, new_uncertainty, new_samples = pool.predict(
+                X_new,
+                k_samples,
+                block_size=block_size,
+                uncertainty_mode=uncertainty_mode,
+                bank=bank,
+                max_samples=max_samples,
+                tolerance=tolerance / scaling_factor,  # tolerance is in output units
+                precision=precision,
+            )
+        else:
+            new_predicted, new_uncertainty, new_samples = PredictiveEngine.predict(
+                regressor,
+                X_new,
+                k_samples,
+                block_size=block_size,
+                device=device,
+                uncertainty_mode=uncertainty_mode,
+                bank=bank,
+                max_samples=max_samples,
+                tolerance=tolerance / scaling_factor,  # tolerance is in output units
+                precision=precision,
+            )
+        if cache is not None:
+            new_keys = [key for key, hit in zip(keys, cached) if not hit]
+            cache.store(new_keys, new_predicted, new_uncertainty, new_samples)
+            predicted[~cached] = new_predicted
+            uncertainty[~cached] = new_uncertainty
+            n_samples[~cached] = new_samples
+        else:
+            predicted, uncertainty, n_samples = (
+                new_predicted,
+                new_uncertainty,
+                new_samples,
+            )
+        predicted = predicted * scaling_factor
+        uncertainty = uncertainty * scaling_factor
+
+        if uncertainty_mode == "adaptive":
+            print(
+                "Samples per row [mean,max]",
+                np.mean(n_samples),
+                "/",
+                np.amax(n_samples),
+            )
+        else:
+            n_samples = None  # only exported for the adaptive mode
+        output_df = build_output_df(
+            df,
+            predicted,
+            uncertainty,
+            output_key,
+            input_key,
+            first_index=n_rows,
+            n_samples=n_samples,
         )
-        regressor = BayesianRegressor(
-            input_dim=n_latents, output_dim=output_size, output_type=output_layer_type
-        ).to(device)
-
-    regressor.load_state_dict(
-        trained_network["model_state_dict"]
-    )  # load state from deserialized object
-    regressor.eval()  # switch to inference mode (set dropout layers)
-
-    # Show information about the model dictionary
-    # Model dictionary contains:
-    # model_dict = {'epochs': num_epochs,
-    #               'batch_size': data_batch_size,
-    #               'learning_rate': learning_rate,
-    #               'lambda_fit_loss': lambda_fit_loss,
-    #               'elbo_kld': elbo_kld,
-    #               'model_state_dict': regressor.state_dict()}
-
-    print(
-        "Model dictionary loaded network ||"
-    )  # For each key in the dictionary, we can check if defined and show warning if not
-    print("\tEpochs: ", trained_network["epochs"])
-    print("\tBatch size: ", trained_network["batch_size"])
-    print("\tLearning rate: ", trained_network["learning_rate"])
-    print("\tLambda fit loss: ", trained_network["lambda_fit_loss"])
-    print("\tELBO k-samples: ", trained_network["elbo_kld"])
-
-    # Apply any pre-existing scaling factor to the input
-    X_norm = np_latent  # for large latents, input to the network
-    print("X_norm [min,max]", np.amin(X_norm), "/", np.amax(X_norm))
-
-    # Then, check the dataframe which should contain the same ordered rows from the latent space (see final step of training/validation)
-    idx = 0
-    Xp_ = torch.tensor(X_norm).float()  # convert normalized intput vector into tensor
-
-    ########################################################################
-
-    # Network is pretrained so we start inferring
-    uncertainty = []
-    predicted = []  # == y
-
-    # For every input (row) we draw a K samples from the posterior
-    for x in Xp_:
-        predictions = []
-        for n in range(k_samples):
-            x_ = x.unsqueeze(0)
-            y_ = regressor(x_.to(device)).detach().cpu().numpy()
-            # p = regressor(x.to(device)).item()
-            predictions.append(y_)  # 1D output, retieve single item
-
-        p_mean = np.mean(predictions, axis=0) * scaling_factor
-        p_stdv = np.std(predictions, axis=0) * scaling_factor
-        predicted.append(p_mean)
-        uncertainty.append(p_stdv)
-
-        idx = idx + 1
-        Console.progress(idx, len(Xp_))
-
-    ########################################################################
-    ########################################################################
-    print("Total predicted rows: ", len(predicted))
-
-    # predicted might contain a dimension with size 1, we need to squeeze it
-    predicted = np.squeeze(predicted)
-
-    # we repeat this for the estimated predictions
-    column_names = []
-    for i in range(
-        output_size
-    ):  # for each entry 'i' we create a column with the name 'y_i'
-        # the column names is created by prepending 'p_' to the column names of the y_df
-        column_names.append(
-            "pred_" + output_key + "_" + str(i)
-        )  # TODO: use the same naming convention as in the training dataframe (retrieved from NN model dictionary maybe?)
-        # column_names.append('predicted_' + str(i))
+        if n_rows == 0:
+            print("Output dataframe columns: ", output_df.head())
+            Console.info("Exporting predictions to:", output_csv)
+        # CSV, Parquet or Arrow output (by extension). Chunks are appended
+        writer.write(output_df)
+        n_rows += len(output_df)
+
+    for function in compiled:
+        function.report()
+    if pool is not None:
+        # with workers, the functions are compiled (and timed) in each worker
+        pool.report()
+        pool.close()
+    if cache is not None:
+        cache.close()
+    writer.close()
+    print("Total predicted rows: ", n_rows)
+    Console.info("Done!")
+    return 0
+
+
+def build_output_df(
+    df, predicted, uncertainty, output_key, input_key, first_index=0, n_samples=None
+):
+    """Appends the predicted mean and uncertainty columns to the input dataframe and
+    removes the latent vector columns, ready to be exported
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Input dataframe (rows matching those of predicted and uncertainty)
+    predicted : np.ndarray
+        Predicted mean, shape (N, output_size)
+    uncertainty : np.ndarray
+        Predicted standard deviation, shape (N, output_size)
+    output_key : str
+        Name used for the prediction columns: pred_<output_key>_<i>, std_<output_key>_<i>
+    input_key : str
+        Prefix (regex) of the latent vector columns to be removed
+    first_index : int
+        Index of the first row, used to keep a continuous index when exporting
+        the predictions in chunks, by default 0
+    n_samples : np.ndarray
+        Optional number of posterior samples drawn for each row, exported as
+        samples_<output_key>, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        Output dataframe, indexed from first_index
+    """
+    output_size = predicted.shape[1]
+    # for each entry 'i' we create a column with the name 'pred_<output_key>_i'
+    # TODO: use the same naming convention as in the training dataframe (retrieved from NN model dictionary maybe?)
+    column_names = ["pred_" + output_key + "_" + str(i) for i in range(output_size)]
     _pdf = pd.DataFrame(predicted, columns=column_names)
 
     # we repeat this for the estimated uncertainty
-    column_names = []
-    for i in range(
-        output_size
-    ):  # for each entry 'i' we create a column with the name 'y_i'
-        # the column names is created by prepending 'p_' to the column names of the y_df
-        column_names.append(
-            "std_" + output_key + "_" + str(i)
-        )  # TODO: use the same naming convention as in the training dataframe (retrieved from NN model dictionary maybe?)
-        # column_names.append('predicted_' + str(i))
-    # predicted might contain a dimension with size 1, we need to squeeze it
-    uncertainty = np.squeeze(uncertainty)
+    column_names = ["std_" + output_key + "_" + str(i) for i in range(output_size)]
     _udf = pd.DataFrame(uncertainty, columns=column_names)
+    if n_samples is not None:
+        _udf["samples_" + output_key] = n_samples
 
-    output_df = df.copy()  # make a copy, then we append the results
-
-    # # we need to preserve the index names for the output dataframe
-    # index_names = output_df.index.names
-    # remove the index names for the dataframe
-    output_df.reset_index(drop=False, inplace=True)
+    # remove the index names for the dataframe (reset_index returns a new dataframe)
+    output_df = df.reset_index(drop=False)
 
     pred_df = pd.concat(
         [_pdf.reset_index(drop=True), _udf.reset_index(drop=True)], axis=1
@@ -240,10 +425,6 @@ def predict_impl(
         inplace=True,
     )  # replace the current df, no need to reassign to a new variable
 
-    print("Output dataframe columns: ", output_df.head())
-    output_name = output_csv
-    Console.info("Exporting predictions to:", output_name)
+    output_df.index = pd.RangeIndex(first_index, first_index + len(output_df))
     output_df.index.names = ["index"]
-    output_df.to_csv(output_name)
-    Console.info("Done!")
-    return 0
+    return output_df
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import asyncio
+import json
+import os
+import signal
+import timeit
+
+import numpy as np
+import torch
+
+from bnn_inference.tools.console import Console
+from bnn_inference.tools.predictor import PredictiveEngine
+
+
+class MicroBatcher:
+    """
+    Coalesces the concurrent requests for a network into micro-batches. A batch is
+    started by the first pending request and closed when it reaches max_batch_rows
+    or after max_delay seconds, whichever comes first. Batches are evaluated in a
+    worker thread, so the event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, regressor, predict_options, max_batch_rows, max_delay):
+        self.regressor = regressor
+        self.predict_options = predict_options
+        self.max_batch_rows = max_batch_rows
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.num_batches = 0
+        self.num_rows = 0
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def predict(self, X):
+        """Queues the rows of X and waits for their predicted mean and std"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((X, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            n_rows = len(pending[0][0])
+            deadline = loop.time() + self.max_delay
+            while n_rows < self.max_batch_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(request)
+                n_rows += len(request[0])
+
+            X = np.concatenate([request[0] for request in pending])
+            try:
+                mean, stdv, _ = await loop.run_in_executor(None, self.evaluate, X)
+            except Exception as ex:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(ex)
+                continue
+            self.num_batches += 1
+            self.num_rows += len(X)
+            start = 0
+            for request, future in pending:
+                stop = start + len(request)
+                if not future.done():  # the client may have gone away
+                    future.set_result((mean[start:stop], stdv[start:stop]))
+                start = stop
+
+    def evaluate(self, X):
+        return PredictiveEngine.predict(
+            self.regressor, X, progress=False, **self.predict_options
+        )
+
+
+class PredictionServer:
+    """
+    Minimal HTTP/1.1 server (standard library only) exposing the resident networks:
+        GET  /health   -> status and loaded networks
+        POST /predict  -> {"network": name, "latents": [[...], ...]} returns
+                          {"network": name, "mean": [[...]], "std": [[...]]}
+    The network name can be omitted when a single network is served.
+    """
+
+    def __init__(self, networks, batchers, scaling_factor):
+        self.networks = networks  # name -> metadata
+        self.batchers = batchers  # name -> MicroBatcher
+        self.scaling_factor = scaling_factor
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = b""
+                if "content-length" in headers:
+                    body = await reader.readexactly(int(headers["content-length"]))
+
+                status, response = await self.dispatch(method, path, body)
+                payload = json.dumps(response).encode()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    (
+                        "HTTP/1.1 {}\r\n"
+                        "Content-Type: application/json\r\n"
+                        "Content-Length: {}\r\n"
+                        "Connection: {}\r\n\r\n"
+                    )
+                    .format(
+                        status, len(payload), "keep-alive" if keep_alive else "close"
+                    )
+                    .encode()
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return "200 OK", {
+                "status": "ok",
+                "networks": self.networks,
+                "batches": {k: b.num_batches for k, b in self.batchers.items()},
+                "rows": {k: b.num_rows for k, b in self.batchers.items()},
+            }
+        if method != "POST" or path != "/predict":
+            return "404 Not Found", {"error": "Unknown endpoint " + method + " " + path}
+        try:
+            request = json.loads(body)
+            name = request.get("network")
+            if name is None and len(self.batchers) == 1:
+                name = next(iter(self.batchers))
+            if name not in self.batchers:
+                return "404 Not Found", {"error": "Unknown network: " + str(name)}
+            X = np.asarray(request["latents"], dtype=np.float64)
+            if X.ndim != 2 or X.shape[1] != self.networks[name]["input_dim"]:
+                raise ValueError(
+                    "latents must have shape (N, {})".format(
+                        self.networks[name]["input_dim"]
+                    )
+                )
+        except (ValueError, KeyError, TypeError, AttributeError) as ex:
+            return "400 Bad Request", {"error": str(ex)}
+        try:
+            mean, stdv = await self.batchers[name].predict(X)
+        except Exception as ex:
+            # failure of the batched evaluation (set on the future by MicroBatcher)
+            Console.error("Prediction failed for network [", name, "]:", ex)
+            return "500 Internal Server Error", {"error": str(ex)}
+        return "200 OK", {
+            "network": name,
+            "mean": (mean * self.scaling_factor).tolist(),
+            "std": (stdv * self.scaling_factor).tolist(),
+        }
+
+
+def parse_network(network, output_layer_type, device):
+    """Loads a network given as 'name=path' (or 'path', named after its file). Files
+    ending in .script.pt are loaded as exported predictors (see export)
+
+    Returns the name, the loaded network and its metadata dictionary"""
+    name, _, filename = network.rpartition("=")
+    if not name:
+        name = os.path.basename(filename).split(".")[0]
+    if not os.path.isfile(filename):
+        Console.quit("No pre-trained network found at: ", filename)
+    Console.info("Loading network [", name, "] from [", filename, "]")
+    if filename.endswith(".script.pt"):
+        regressor, metadata = PredictiveEngine.loadScripted(filename, None, device)
+        metadata = {"input_dim": metadata["input_dim"], "backend": "script"}
+    else:
+        regressor, _ = PredictiveEngine.loadNetwork(
+            filename, None, output_layer_type, device
+        )
+        metadata = {
+            "input_dim": regressor.linear_input.in_features,
+            "backend": "torch",
+        }
+    metadata["output_dim"] = regressor.linear_output.out_features
+    metadata["filename"] = filename
+    return name, regressor, metadata
+
+
+def serve_impl(
+    networks,
+    output_layer_type,
+    host,
+    port,
+    socket_path,
+    num_samples,
+    scale_factor,
+    uncertainty_mode,
+    block_size,
+    max_batch_rows,
+    max_delay_ms,
+    num_threads,
+):
+    Console.info("Prediction server: keeps the trained networks resident in memory")
+    if len(networks) == 0:
+        Console.quit("At least one network (--network) is required")
+    if uncertainty_mode not in ["mc", "moments"]:
+        Console.quit("Unknown uncertainty mode for serve: ", uncertainty_mode)
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    device = torch.device("cpu")  # serve runs fully on the CPU node
+
+    loaded = {}
+    for network in networks:
+        name, regressor, metadata = parse_network(network, output_layer_type, device)
+        if uncertainty_mode == "moments" and metadata["backend"] == "script":
+            Console.quit("Moment propagation requires the torch backend: ", network)
+        loaded[name] = (regressor, metadata)
+    predict_options = {
+        "num_samples": num_samples,
+        "block_size": block_size,
+        "device": device,
+        "uncertainty_mode": uncertainty_mode,
+    }
+
+    async def main():
+        batchers = {
+            name: MicroBatcher(
+                regressor, predict_options, max_batch_rows, max_delay_ms / 1000.0
+            )
+            for name, (regressor, _) in loaded.items()
+        }
+        server = PredictionServer(
+            {name: metadata for name, (_, metadata) in loaded.items()},
+            batchers,
+            scale_factor,
+        )
+        if socket_path:
+            listener = await asyncio.start_unix_server(
+                server.handle_connection, path=socket_path
+            )
+            Console.info("Listening on unix socket: ", socket_path)
+        else:
+            listener = await asyncio.start_server(
+                server.handle_connection, host=host, port=port
+            )
+            Console.info("Listening on http://{}:{}".format(host, port))
+        async with listener:
+            await listener.serve_forever()
+
+    # Stop cleanly (removing the unix socket) on SIGTERM too, e.g. from a job scheduler
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    start = timeit.default_timer()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        Console.info(
+            "Server stopped after {:.1f} s".format(timeit.default_timer() - start)
+        )
+    finally:
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return 0
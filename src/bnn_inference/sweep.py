@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import contextlib
+import inspect
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+
+from bnn_inference.tools.console import Console
+from bnn_inference.tools.table_io import write_table
+from bnn_inference.train import load_training_dataset, train_impl
+
+# Metrics used to rank the trials (validation split, lower is better)
+SWEEP_METRICS = ["valid_rmse", "valid_nll", "valid_loss"]
+
+# Options set by the sweep itself, they cannot be part of the search space
+SWEEP_OPTIONS = [
+    "latent_csv",
+    "latent_key",
+    "target_csv",
+    "target_key",
+    "uuid_key",
+    "output_csv",
+    "output_network_filename",
+    "log_filename",
+    "gpu_index",
+    "cpu_only",
+    "dataset_cache",
+    "checkpoint_every",
+    "resume",
+    "dataset",
+]
+
+# Former names of some train options (e.g. --lambda-recon in older scripts)
+PARAMETER_ALIASES = {"lambda_recon": "lambda_loss"}
+
+
+def train_defaults():
+    """Returns the default value of each train_impl option that the search space can
+    set (the same defaults as the train command)"""
+    return {
+        name: parameter.default
+        for name, parameter in inspect.signature(train_impl).parameters.items()
+        if parameter.default is not inspect.Parameter.empty
+        and name not in SWEEP_OPTIONS
+    }
+
+
+def option_name(name):
+    """Returns the train_impl name of a train option ('lambda-elbo' -> 'lambda_elbo')"""
+    name = name.replace("-", "_").lstrip("_")
+    return PARAMETER_ALIASES.get(name, name)
+
+
+def load_search_space(filename):
+    """Reads the YAML search space of a sweep:
+
+        method: grid            # 'grid' (all the combinations) or 'random'
+        num_trials: 20          # number of trials of the random search
+        parameters:             # train options explored by the sweep
+          lambda_elbo: [1, 10, 100]                    # list of values
+          learning_rate: {min: 1.0e-4, max: 1.0e-2, log: true}  # range (random)
+        fixed:                  # train options shared by all the trials
+          batch_size: 64
+
+    Returns the method, number of trials, parameters and fixed options, with the
+    option names as in train_impl"""
+    with open(filename, "r") as f:
+        space = yaml.safe_load(f) or {}
+    method = space.get("method", "grid")
+    num_trials = int(space.get("num_trials", 0))
+    parameters = {
+        option_name(name): values
+        for name, values in (space.get("parameters") or {}).items()
+    }
+    fixed = {
+        option_name(name): value for name, value in (space.get("fixed") or {}).items()
+    }
+    valid_options = [
+        name
+        for name in inspect.signature(train_impl).parameters
+        if name not in SWEEP_OPTIONS
+    ]
+    for name in list(parameters) + list(fixed):
+        if name not in valid_options:
+            Console.error("Unknown or reserved train option in the search space:", name)
+            Console.error("Currently valid options are: " + ", ".join(valid_options))
+            Console.quit("Leaving...")
+    if method not in ["grid", "random"]:
+        Console.error("Unknown search method:", method)
+        Console.error("Currently valid options are: grid, random")
+        Console.quit("Leaving...")
+    return method, num_trials, parameters, fixed
+
+
+def sample_trials(method, parameters, num_trials, seed=0):
+    """Returns the list of trials (dictionary of train options) of the search space.
+    The grid search returns every combination of the listed values. The random search
+    draws num_trials trials: values are picked from the lists, and ranges
+    ({min, max, log}) are sampled uniformly (log-uniformly with log: true, integers
+    if both bounds are integers)"""
+    names = list(parameters)
+    if method == "grid":
+        for name in names:
+            if not isinstance(parameters[name], list):
+                Console.quit("Grid search requires a list of values for", name)
+        return [
+            dict(zip(names, values))
+            for values in itertools.product(*(parameters[name] for name in names))
+        ]
+    if num_trials <= 0:
+        Console.quit("Random search requires num_trials in the search space")
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(num_trials):
+        trial = {}
+        for name in names:
+            space = parameters[name]
+            if isinstance(space, list):
+                trial[name] = rng.choice(space)
+            elif isinstance(space["min"], int) and isinstance(space["max"], int):
+                trial[name] = rng.randint(space["min"], space["max"])
+            elif space.get("log", False):
+                trial[name] = math.exp(
+                    rng.uniform(math.log(space["min"]), math.log(space["max"]))
+                )
+            else:
+                trial[name] = rng.uniform(space["min"], space["max"])
+        trials.append(trial)
+    return trials
+
+
+def halving_rungs(min_epochs, max_epochs, reduction_factor):
+    """Epoch budgets of the successive halving rungs: min_epochs multiplied by the
+    reduction factor at each rung, up to max_epochs"""
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= reduction_factor
+    rungs.append(max_epochs)
+    return rungs
+
+
+def share_array(array):
+    """Copies array to a new shared memory block. Returns the block (to be closed and
+    unlinked by the caller) and the descriptor used by attach_array"""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def attach_array(descriptor):
+    """Maps the shared memory block of a descriptor (see share_array) as an array,
+    without copying it. Returns the block, that has to stay referenced, and the array"""
+    name, shape, dtype = descriptor
+    # The spawned workers share the resource tracker of the parent process, which
+    # unlinks the block at the end of the sweep
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+# Dataset shared by the trials of each worker process of the sweep
+_worker_blocks = []
+_worker_dataset = None
+
+
+def _init_worker(shared_dataset, num_threads):
+    global _worker_dataset
+    # Limit the intra-op threads so that the concurrent trials do not oversubscribe
+    # the cores
+    torch.set_num_threads(num_threads)
+    X_descriptor, y_descriptor, latent_columns, target_columns = shared_dataset
+    X_block, X = attach_array(X_descriptor)
+    y_block, y = attach_array(y_descriptor)
+    _worker_blocks.extend([X_block, y_block])
+    _worker_dataset = (
+        pd.DataFrame(X, columns=latent_columns, copy=False),
+        pd.DataFrame(y, columns=target_columns, copy=False),
+        None,  # the UUIDs are not used for training
+    )
+
+
+def _run_trial(trial_id, options, seed):
+    """Trains a trial in a worker process. The console output of the trial is written
+    to train.log in its directory. Returns the trial id, the summary returned by
+    train_impl (None if the trial failed) and the error message"""
+    directory = os.path.dirname(options["output_network_filename"])
+    with open(os.path.join(directory, "train.log"), "a") as log:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            # Same seed for all the trials: same train/validation split. A resumed
+            # trial restores the random state of its checkpoint instead
+            random.seed(seed)
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+            try:
+                return trial_id, train_impl(**options, dataset=_worker_dataset), ""
+            except (Exception, SystemExit) as ex:  # Console.quit raises SystemExit
+                traceback.print_exc()
+                return trial_id, None, repr(ex)
+
+
+def trial_score(result, metric):
+    """Ranking score of a trial: its metric, or infinity if it failed or diverged"""
+    value = result.get(metric, math.nan)
+    if result["status"] == "failed" or value is None or math.isnan(value):
+        return math.inf
+    return value
+
+
+def sweep_impl(
+    latent_csv,
+    latent_key,
+    target_csv,
+    target_key,
+    uuid_key,
+    search_space,
+    output_dir,
+    num_epochs=100,
+    min_epochs=0,
+    reduction_factor=3,
+    metric="valid_rmse",
+    workers=1,
+    threads_per_trial=0,
+    seed=0,
+    dataset_cache="",
+    gpu_index=0,
+    cpu_only=False,
+):
+    Console.info("Hyperparameter sweep over the training options")
+    if metric not in SWEEP_METRICS:
+        Console.error("Unknown sweep metric:", metric)
+        Console.error("Currently valid options are: " + ", ".join(SWEEP_METRICS))
+        Console.quit("Leaving...")
+    method, num_trials, parameters, fixed = load_search_space(search_space)
+    trials = sample_trials(method, parameters, num_trials, seed)
+    if min_epochs > 0:
+        # Successive halving: all the trials are trained for min_epochs, then only the
+        # best 1/reduction_factor continue, with reduction_factor times more epochs
+        if "num_epochs" in parameters:
+            Console.quit("num_epochs is the sweep budget, it cannot be a parameter")
+        if reduction_factor < 2:
+            Console.quit("The reduction factor must be at least 2")
+        rungs = halving_rungs(min_epochs, num_epochs, reduction_factor)
+        Console.info("Successive halving rungs (epochs):", rungs)
+    else:
+        rungs = [None]  # a single rung, each trial trains for its num_epochs
+    # The trials resume from the checkpoint of the previous rung, so a checkpoint is
+    # saved at the end of every rung
+    checkpoint_every = math.gcd(*rungs) if min_epochs > 0 else 0
+    Console.info("Sweep:", len(trials), "trials (" + method + " search)")
+
+    os.makedirs(output_dir, exist_ok=True)
+    trial_options = []
+    for trial_id, trial in enumerate(trials):
+        directory = os.path.join(output_dir, "trial_{:03d}".format(trial_id))
+        os.makedirs(directory, exist_ok=True)
+        options = dict(train_defaults(), num_epochs=num_epochs)
+        options.update(fixed)
+        options.update(trial)
+        options.update(
+            latent_csv=latent_csv,
+            latent_key=latent_key,
+            target_csv=target_csv,
+            target_key=target_key,
+            uuid_key=uuid_key,
+            output_csv=os.path.join(directory, "predictions.csv"),
+            output_network_filename=os.path.join(directory, "network.pth"),
+            log_filename=os.path.join(directory, "log.csv"),
+            gpu_index=gpu_index,
+            cpu_only=cpu_only,
+            checkpoint_every=checkpoint_every,
+        )
+        trial_options.append(options)
+
+    # The dataset is loaded and joined once, and shared with the workers
+    X_df, y_df, _ = load_training_dataset(
+        latent_csv, latent_key, target_csv, target_key, uuid_key, dataset_cache
+    )
+    X_block, X_descriptor = share_array(X_df.to_numpy(dtype=np.float32))
+    y_block, y_descriptor = share_array(y_df.to_numpy(dtype=np.float32))
+    shared_dataset = (
+        X_descriptor,
+        y_descriptor,
+        [str(c) for c in X_df.columns],
+        [str(c) for c in y_df.columns],
+    )
+    del X_df, y_df
+    if threads_per_trial <= 0:
+        threads_per_trial = max(1, (os.cpu_count() or 1) // workers)
+    Console.info(
+        "Running", workers, "concurrent trials with", threads_per_trial, "threads each"
+    )
+
+    results = [
+        {"trial": trial_id, "status": "pending", "rung": -1, "epochs": 0}
+        for trial_id in range(len(trials))
+    ]
+    active = list(range(len(trials)))
+    try:
+        # spawn (rather than fork) as the parent process has already initialised torch
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(shared_dataset, threads_per_trial),
+        ) as executor:
+            for rung, epochs in enumerate(rungs):
+                if epochs is not None:
+                    Console.info(
+                        "Rung", rung, "|", len(active), "trials x", epochs, "epochs"
+                    )
+                futures, budgets = {}, {}
+                for trial_id in active:
+                    options = dict(trial_options[trial_id], resume=rung > 0)
+                    if epochs is not None:
+                        options["num_epochs"] = epochs
+                    budgets[trial_id] = options["num_epochs"]
+                    future = executor.submit(_run_trial, trial_id, options, seed)
+                    futures[future] = trial_id
+                broken = False
+                for done, future in enumerate(as_completed(futures)):
+                    trial_id = futures[future]
+                    try:
+                        _, summary, error = future.result()
+                    except Exception as ex:
+                        # The worker died (e.g. killed by the OOM killer): the trial
+                        # fails, and the pool cannot run any other trial
+                        summary, error = None, repr(ex)
+                        broken = broken or isinstance(ex, BrokenProcessPool)
+                    result = results[trial_id]
+                    if summary is None:
+                        Console.warn(
+                            "Trial",
+                            trial_id,
+                            "failed:",
+                            error,
+                            "| see train.log in",
+                            os.path.dirname(trial_options[trial_id]["log_filename"]),
+                        )
+                        result.update(status="failed", error=error)
+                    else:
+                        # An early-stopped trial is not promoted: it would resume
+                        # from an older checkpoint and stop again
+                        stopped = summary["trained_epochs"] < budgets[trial_id]
+                        status = "stopped" if stopped else "completed"
+                        result.update(summary, status=status, rung=rung)
+                        result["epochs"] = summary["trained_epochs"]
+                    Console.progress(done + 1, len(futures))
+                if broken:
+                    Console.error("A worker process died, the sweep is stopped")
+                    break
+                if rung == len(rungs) - 1:
+                    break
+                # Only the best 1/reduction_factor trials go to the next rung
+                keep = max(1, len(active) // reduction_factor)
+                active = [t for t in active if results[t]["status"] == "completed"]
+                active.sort(key=lambda trial_id: trial_score(results[trial_id], metric))
+                for trial_id in active[keep:]:
+                    results[trial_id]["status"] = "pruned"
+                active = active[:keep]
+    finally:
+        for block in (X_block, y_block):
+            block.close()
+            block.unlink()
+
+    rows = []
+    for trial, result in zip(trials, results):
+        rows.append(dict(result, **trial))
+    results_df = pd.DataFrame(rows)
+    # Ranking: trials that reached the last rung first, then by metric
+    results_df["score"] = [trial_score(result, metric) for result in results]
+    results_df = results_df.sort_values(
+        ["rung", "score"], ascending=[False, True], kind="stable"
+    ).drop(columns="score")
+    results_filename = os.path.join(output_dir, "sweep_results.csv")
+    write_table(results_df, results_filename, index=False)
+    Console.info("Sweep results exported to:", results_filename)
+
+    best = results_df.iloc[0]
+    if best["status"] == "failed":
+        Console.quit("All the trials failed, see train.log in each trial directory")
+    Console.info(
+        "Best trial:",
+        best["trial"],
+        "|",
+        metric,
+        "{:.4f}".format(best[metric]),
+        "|",
+        ", ".join(str(name) + "=" + str(best[name]) for name in parameters),
+    )
+    return results_df
@@ -8,19 +8,117 @@ See LICENSE file in the project root for full license information.
 # Author: Jose Cappelletto (j.cappelletto@soton.ac.uk)
 
 import math
-import statistics
 
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 # Import blitz (BNN) modules
 from blitz.modules import BayesianLinear
 from blitz.utils import variational_estimator
 
+from bnn_inference.tools.utilities import autocast
+
+# Gauss-Hermite quadrature used to propagate Gaussian moments through the SiLU units
+GAUSS_HERMITE_NODES, GAUSS_HERMITE_WEIGHTS = np.polynomial.hermite.hermgauss(16)
+
+
+def silu_moments(mean, var):
+    """Moments of SiLU(z) for z ~ N(mean, var), computed elementwise with Gauss-Hermite
+    quadrature. Returns the mean and variance of SiLU(z) and the expected value of its
+    derivative E[SiLU'(z)], used to propagate covariances (Stein's lemma)"""
+    nodes = torch.as_tensor(GAUSS_HERMITE_NODES, dtype=mean.dtype, device=mean.device)
+    weights = torch.as_tensor(
+        GAUSS_HERMITE_WEIGHTS / math.sqrt(math.pi), dtype=mean.dtype, device=mean.device
+    )
+    z = mean.unsqueeze(-1) + torch.sqrt(2.0 * var).unsqueeze(-1) * nodes
+    sig = torch.sigmoid(z)
+    f = z * sig
+    f_mean = (f * weights).sum(-1)
+    f_var = torch.clamp((f * f * weights).sum(-1) - f_mean * f_mean, min=0.0)
+    df_mean = (sig * (1.0 + z * (1.0 - sig)) * weights).sum(-1)
+    return f_mean, f_var, df_mean
+
+
+class LocalReparameterisationLinear(BayesianLinear):
+    """
+    Bayesian linear layer using the local reparameterisation trick (Kingma et al.,
+    2015). Instead of sampling one weight matrix shared by the whole batch, the
+    Gaussian pre-activations are sampled independently for each example, which gives
+    lower variance gradients. It has the same parameters (state_dict layout),
+    priors and complexity cost as the blitz BayesianLinear it replaces.
+    """
+
+    local_reparameterisation = True
+    # Set by the ELBO when the Monte Carlo complexity cost ('mc' KL method) is needed
+    complexity_cost = False
+
+    def forward(self, x):
+        if self.freeze:
+            return self.forward_frozen(x)
+        if self.complexity_cost:
+            # The complexity cost is estimated from a weight sample, as blitz does
+            w = self.weight_sampler.sample()
+            b = self.bias_sampler.sample()
+            self.log_variational_posterior = (
+                self.weight_sampler.log_posterior() + self.bias_sampler.log_posterior()
+            )
+            b_log_prior = self.bias_prior_dist.log_prior(b)
+            self.log_prior = self.weight_prior_dist.log_prior(w) + b_log_prior
+        else:
+            # No weight sample (e.g. prediction, analytic KL): a stale complexity cost
+            # must not be read
+            self.log_variational_posterior = self.log_prior = None
+        return self.sample_preactivations(x, 1)[0]
+
+    def sample_preactivations(self, x, sample_nbr):
+        """Draws sample_nbr independent samples of the Gaussian pre-activations of x
+        Parameters:
+            x: torch.tensor -> input block, shape (..., in_features)
+            sample_nbr: int -> number of samples (K)
+        Returns torch.tensor of shape (K, ..., out_features)
+        """
+        mu_w, mu_b = self.weight_sampler.mu, self.bias_sampler.mu
+        # same parametrisation as blitz: sigma = log(1 + exp(rho))
+        sigma_w = torch.log1p(torch.exp(self.weight_sampler.rho))
+        sigma_b = torch.log1p(torch.exp(self.bias_sampler.rho))
+        mean = F.linear(x, mu_w, mu_b)
+        std = torch.sqrt(F.linear(x * x, sigma_w**2, sigma_b**2) + 1e-16)
+        eps = torch.randn(
+            (sample_nbr,) + tuple(mean.shape), device=mean.device, dtype=mean.dtype
+        )
+        return mean + std * eps
+
+
+# Bayesian layers available for BayesianRegressor (blinear1), by name
+BAYESIAN_LAYERS = {
+    "blitz": BayesianLinear,
+    "local": LocalReparameterisationLinear,
+}
+
+
+def prior_sigma(prior):
+    """Standard deviation of a blitz prior (PriorWeightDistribution) when it is a single
+    zero-mean Gaussian: a scale mixture with pi = 1 (or 0), or with equal scales.
+    Returns None otherwise (no closed-form KL divergence)"""
+    components = [(prior.dist1, prior.pi)]
+    if prior.dist2 is not None:
+        components.append((prior.dist2, 1 - prior.pi))
+    dists = [dist for dist, weight in components if weight > 0]
+    if not all(isinstance(dist, torch.distributions.Normal) for dist in dists):
+        return None
+    scales = {float(dist.scale) for dist in dists}
+    if len(scales) != 1 or any(float(dist.loc) != 0.0 for dist in dists):
+        return None
+    return scales.pop()
+
 
 @variational_estimator
 class BayesianRegressor(nn.Module):
-    def __init__(self, input_dim, output_dim, output_type="linear"):
+    def __init__(
+        self, input_dim, output_dim, output_type="linear", bayesian_layer="blitz"
+    ):
         super().__init__()
 
         # We can define at construction time the type of last layer: linear, softmax or softmin
@@ -46,7 +144,12 @@ class BayesianRegressor(nn.Module):
 
         self.linear_input = nn.Linear(input_dim, DIM1, bias=True)
 
-        self.blinear1 = BayesianLinear(
+        # Bayesian layer: blitz (one weight sample per forward pass) or local
+        # reparameterisation (pre-activations sampled per example), same parameters
+        if bayesian_layer not in BAYESIAN_LAYERS:
+            raise ValueError("Unknown Bayesian layer: " + str(bayesian_layer))
+        self.bayesian_layer = bayesian_layer
+        self.blinear1 = BAYESIAN_LAYERS[bayesian_layer](
             DIM1, DIM1, bias=True, prior_sigma_1=0.5, prior_sigma_2=0.5
         )
         self.silu1 = nn.SiLU()
@@ -75,8 +178,21 @@ class BayesianRegressor(nn.Module):
     # Oceans2021 architecture: 256 x SiLU | 521 x SiLU | 128 x Lin | 64 x Lin | y: output
 
     def forward(self, x):
-        x_ = self.linear_input(x)
-        x_ = self.silu1(self.blinear1(x_))
+        return self.forward_suffix(self.forward_prefix(x))
+
+    def forward_prefix(self, x):
+        """Deterministic input stage of the network (linear_input). Its output does not
+        change between posterior samples, so it can be computed once and shared"""
+        return self.linear_input(x)
+
+    def forward_suffix(self, x_):
+        """Stochastic stage of the network, from the Bayesian layer (blinear1) to the
+        output. Each call draws a new set of weights"""
+        return self.forward_tail(self.blinear1(x_))
+
+    def forward_tail(self, x_):
+        """Deterministic stage of the network that follows the Bayesian layer"""
+        x_ = self.silu1(x_)
         x_ = self.silu2(self.linear2(x_))
         x_ = self.linear3(x_)
         x_ = self.linear_output(x_)
@@ -87,6 +203,194 @@ class BayesianRegressor(nn.Module):
         # x_ = F.normalize (x_, p=1, dim=-1)
         return x_
 
+    def sample(self, x, sample_nbr):
+        """Draws sample_nbr posterior predictions for the input block x. The deterministic
+        prefix is computed once and only the stochastic suffix is run sample_nbr times
+        Parameters:
+            x: torch.tensor -> input block, shape (..., input_dim)
+            sample_nbr: int -> number of posterior samples to draw
+        Returns torch.tensor of shape (sample_nbr, ..., output_dim)
+        """
+        x_ = self.forward_prefix(x)
+        return torch.stack([self.forward_suffix(x_) for _ in range(sample_nbr)])
+
+    def forward_suffix_samples(self, x_, sample_nbr, complexity_cost=True):
+        """Batched version of forward_suffix: draws sample_nbr independent weight samples
+        of the Bayesian layer (with gradients, as blitz does) and evaluates all of them in
+        a single pass. The complexity cost of each draw is computed as blitz does
+        (log variational posterior - log prior, Monte Carlo estimate). With the local
+        reparameterisation layer, the pre-activations are sampled per example instead
+        Parameters:
+            x_: torch.tensor -> output of forward_prefix, shape (N, DIM1)
+            sample_nbr: int -> number of weight samples (K)
+            complexity_cost: bool -> if False, the complexity cost is not computed (None)
+        Returns tuple(torch.tensor, torch.tensor) -> outputs with shape (K, N, output_dim)
+            and the complexity cost of each weight sample, shape (K)
+        """
+        blinear = self.blinear1
+        local = getattr(blinear, "local_reparameterisation", False)
+        log_posterior = 0
+        log_prior = 0
+        samples = []
+        for sampler, prior in (
+            (blinear.weight_sampler, blinear.weight_prior_dist),
+            (blinear.bias_sampler, blinear.bias_prior_dist),
+        ):
+            if local and not complexity_cost:
+                break  # the weight samples are only needed for the complexity cost
+            mu = sampler.mu
+            sigma = torch.log1p(torch.exp(sampler.rho))
+            eps = torch.randn(
+                (sample_nbr,) + tuple(mu.shape), device=mu.device, dtype=mu.dtype
+            )
+            w = mu + sigma * eps
+            samples.append(w)
+            if not complexity_cost:
+                continue
+            dims = tuple(range(1, w.dim()))  # sum over everything but the samples
+            log_posterior = log_posterior + (
+                -math.log(math.sqrt(2 * math.pi))
+                - torch.log(sigma)
+                - ((w - mu) ** 2) / (2 * sigma**2)
+                - 0.5
+            ).sum(dims)
+            prior_pdf = prior.pi * torch.exp(prior.dist1.log_prob(w))
+            if prior.dist2 is not None:
+                prior_pdf = prior_pdf + (1 - prior.pi) * torch.exp(
+                    prior.dist2.log_prob(w)
+                )
+            log_prior = log_prior + (torch.log(prior_pdf) - 0.5).sum(dims)
+        if local:
+            x_ = blinear.sample_preactivations(x_, sample_nbr)
+        else:
+            weight, bias = samples
+            x_ = torch.einsum("ni,koi->kno", x_, weight) + bias.unsqueeze(1)
+        # The tail is evaluated on the flattened (K x N) rows, as the output layer
+        # (softmax/softmin) normalises along the second dimension
+        y_ = self.forward_tail(x_.reshape(sample_nbr * x_.shape[1], -1))
+        y_ = y_.reshape(sample_nbr, x_.shape[1], -1)
+        if not complexity_cost:
+            return y_, None
+        return y_, log_posterior - log_prior
+
+    def kl_divergence_analytic(self):
+        """Closed-form KL divergence between the Gaussian posterior of the Bayesian layer
+        and its prior, which must be a single zero-mean Gaussian (see prior_sigma). It is
+        the expected value of the Monte Carlo estimate of blitz (nn_kl_divergence), with
+        no sampling noise
+        Returns torch.tensor -> KL divergence (scalar)
+        """
+        blinear = self.blinear1
+        kl = 0
+        for sampler, prior in (
+            (blinear.weight_sampler, blinear.weight_prior_dist),
+            (blinear.bias_sampler, blinear.bias_prior_dist),
+        ):
+            sigma_p = prior_sigma(prior)
+            if sigma_p is None:
+                raise ValueError("The analytic KL divergence requires a Gaussian prior")
+            sigma = torch.log1p(torch.exp(sampler.rho))
+            kl_elements = (
+                math.log(sigma_p)
+                - torch.log(sigma)
+                + (sigma**2 + sampler.mu**2) / (2 * sigma_p**2)
+                - 0.5
+            )
+            kl = kl + kl_elements.sum()
+        return kl
+
+    def draw_weight_bank(self, sample_nbr, seed=None):
+        """Draws sample_nbr weight (and bias) samples of the Bayesian layer from its
+        posterior, so they can be reused across inputs and runs (weight-sample bank).
+        The samples are drawn on the CPU, so a given seed gives the same bank on any
+        device
+        Parameters:
+            sample_nbr: int -> number of weight samples (K)
+            seed: int -> seed of the random generator, by default None (random)
+        Returns dict -> 'weight' (K, out, in) and 'bias' (K, out) tensors
+        """
+        generator = torch.Generator()
+        if seed is None:
+            generator.seed()
+        else:
+            generator.manual_seed(seed)
+        blinear = self.blinear1
+        bank = {}
+        for name, mu, rho in (
+            ("weight", blinear.weight_mu, blinear.weight_rho),
+            ("bias", blinear.bias_mu, blinear.bias_rho),
+        ):
+            mu = mu.detach().cpu()
+            eps = torch.randn((sample_nbr,) + mu.shape, generator=generator)
+            if blinear.freeze:
+                eps.zero_()
+            # same parametrisation as blitz: w = mu + log(1 + exp(rho)) * eps
+            bank[name] = mu + F.softplus(rho.detach().cpu()) * eps
+        return bank
+
+    def forward_bank(self, x, bank):
+        """Evaluates every row of the input block x against all the weight samples of
+        a bank (see draw_weight_bank) with a single batched matmul
+        Parameters:
+            x: torch.tensor -> input block, shape (N, input_dim)
+            bank: dict -> weight-sample bank, on the same device as x
+        Returns torch.tensor of shape (K, N, output_dim)
+        """
+        x_ = self.forward_prefix(x)
+        x_ = torch.einsum("ni,koi->kno", x_, bank["weight"]) + bank["bias"].unsqueeze(1)
+        sample_nbr, n_rows = x_.shape[:2]
+        # The tail is evaluated on the flattened (K x N) rows, as the output layer
+        # (softmax/softmin) normalises along the second dimension
+        y_ = self.forward_tail(x_.reshape(sample_nbr * n_rows, -1))
+        return y_.reshape(sample_nbr, n_rows, -1)
+
+    def forward_moments(self, x):
+        """Sampling-free approximation of the predictive mean and variance (moment
+        propagation). The Gaussian weights of blinear1 give independent Gaussian
+        pre-activations; their moments are propagated through the SiLU units by
+        quadrature, and through the linear tail with full covariance (cross-covariances
+        of the second SiLU are linearised). Only valid for the linear output layer
+        Parameters:
+            x: torch.tensor -> input block, shape (..., input_dim)
+        Returns tuple(torch.tensor, torch.tensor) -> predictive mean and variance, each
+            with shape (..., output_dim)
+        """
+        if not isinstance(self.last_layer, nn.Identity):
+            raise ValueError("Moment propagation requires a linear output layer")
+        x_ = self.forward_prefix(x)
+
+        # Bayesian layer: each output unit uses its own (independent) row of weights,
+        # so the pre-activations are independent Gaussians
+        blinear = self.blinear1
+        mean = F.linear(x_, blinear.weight_mu, blinear.bias_mu)
+        if blinear.freeze:
+            var = torch.zeros_like(mean)
+        else:
+            # same parametrisation as blitz: sigma = log(1 + exp(rho))
+            weight_var = F.softplus(blinear.weight_rho) ** 2
+            bias_var = F.softplus(blinear.bias_rho) ** 2
+            var = F.linear(x_ * x_, weight_var, bias_var)
+        mean, var, _ = silu_moments(mean, var)
+
+        # linear2: from here on the units are correlated. The covariance after the
+        # second SiLU is linearised (Cov ~ G W2 diag(var) W2^T G, G = diag(E[SiLU']))
+        # except for its diagonal, which keeps the quadrature variances
+        var_in = var
+        weight2 = self.linear2.weight
+        mean = self.linear2(mean)
+        var = F.linear(var_in, weight2 * weight2)
+        mean, var_out, grad = silu_moments(mean, var)
+
+        # linear3 and linear_output are both linear, fold them into a single map A.
+        # Only the diagonal of A Cov A^T is needed, so the full covariance is not built
+        weight = self.linear_output.weight @ self.linear3.weight
+        mean = self.linear_output(self.linear3(mean))
+        gain = (weight * grad.unsqueeze(-2)) @ weight2
+        var = (gain * gain * var_in.unsqueeze(-2)).sum(-1) + F.linear(
+            var_out - grad * grad * var, weight * weight
+        )
+        return mean, torch.clamp(var, min=0.0)
+
     def sample_elbo_weighted_mse(
         self,
         inputs,
@@ -95,6 +399,8 @@ class BayesianRegressor(nn.Module):
         sample_nbr,
         criterion_loss_weight=1,
         complexity_cost_weight=1,
+        kl_method="mc",
+        kl_divergence=None,
     ):
         """Samples the ELBO Loss for a batch of data, consisting of inputs and corresponding-by-index labels
             The ELBO Loss consists of the sum of the KL Divergence of the model
@@ -111,27 +417,67 @@ class BayesianRegressor(nn.Module):
                         the performance cost for the model
             sample_nbr: int -> The number of times of the weight-sampling and predictions done in our Monte-Carlo approach to
                         gather the loss to be .backwarded in the optimization of the model.
+            kl_method: str -> 'mc' estimates the KL divergence from the sampled weights (blitz), 'analytic' uses the
+                        closed-form KL divergence (see kl_divergence_analytic)
+            kl_divergence: torch.tensor -> precomputed closed-form KL divergence (e.g. cached for a validation pass,
+                        while the weights do not change), by default None (computed)
         """
 
         loss = 0
         criterion_loss = 0
         kldiverg_loss = 0
+        # The closed-form KL does not depend on the samples, so it is computed once
+        analytic_kl = kl_method == "analytic"
         # y_target = torch.ones(labels.shape[0], device=torch.device("cuda"))
-        for _ in range(sample_nbr):
-            outputs = self(inputs)
-            # # print the output of the model for each sample and its shape
-            # print ("Iteration: ", i)
-            # print (outputs)
-            # print (outputs.shape)
-            # print (labels)
-            # print (labels.shape)
-            # print ("--------------------------------------")
-
-            criterion_loss += criterion(outputs, labels)
-            kldiverg_loss += self.nn_kl_divergence()
-
-        criterion_loss = criterion_loss_weight * criterion_loss / sample_nbr
-        kldiverg_loss = complexity_cost_weight * kldiverg_loss / sample_nbr
+        # The deterministic prefix is shared by all the samples
+        inputs_ = self.forward_prefix(inputs)
+        if (
+            sample_nbr > 1
+            and not self.blinear1.freeze
+            and getattr(criterion, "reduction", "") == "mean"
+        ):
+            # All the samples in a single pass. For mean-reduced criteria, the criterion
+            # over the stacked (K x N) outputs is the mean of the K per-sample criteria
+            outputs, kldiverg_loss = self.forward_suffix_samples(
+                inputs_, sample_nbr, complexity_cost=not analytic_kl
+            )
+            labels = labels.expand((sample_nbr,) + tuple(labels.shape))
+            # the criterion is evaluated in float32, also under bfloat16 autocast
+            criterion_loss = criterion(
+                outputs.float().reshape((-1,) + tuple(outputs.shape[2:])),
+                labels.reshape((-1,) + tuple(labels.shape[2:])),
+            )
+            if not analytic_kl:
+                kldiverg_loss = kldiverg_loss.mean()
+        else:
+            # The local reparameterisation layer only draws the weight sample of the
+            # complexity cost when it is needed
+            self.blinear1.complexity_cost = not analytic_kl
+            try:
+                for _ in range(sample_nbr):
+                    outputs = self.forward_suffix(inputs_)
+                    # # print the output of the model for each sample and its shape
+                    # print ("Iteration: ", i)
+                    # print (outputs)
+                    # print (outputs.shape)
+                    # print (labels)
+                    # print (labels.shape)
+                    # print ("--------------------------------------")
+
+                    criterion_loss += criterion(outputs.float(), labels)
+                    if not analytic_kl:
+                        kldiverg_loss += self.nn_kl_divergence()
+            finally:
+                self.blinear1.complexity_cost = False
+            criterion_loss = criterion_loss / sample_nbr
+            kldiverg_loss = kldiverg_loss / sample_nbr
+
+        if analytic_kl:
+            kldiverg_loss = kl_divergence
+            if kldiverg_loss is None:
+                kldiverg_loss = self.kl_divergence_analytic()
+        criterion_loss = criterion_loss_weight * criterion_loss
+        kldiverg_loss = complexity_cost_weight * kldiverg_loss
         loss = criterion_loss + kldiverg_loss
 
         return loss, criterion_loss, kldiverg_loss
@@ -172,12 +518,17 @@ class BayesianRegressor(nn.Module):
             labels.shape[0], device=torch.device("cuda")
         ) - torch.cosine_similarity(inputs, labels, dim=1)
 
-        for _ in range(sample_nbr):
-            outputs = self(inputs)
-            criterion_loss += criterion(
-                outputs, labels, y_target
-            )  # use this for cosine
-            kldiverg_loss += self.nn_kl_divergence()
+        inputs_ = self.forward_prefix(inputs)
+        self.blinear1.complexity_cost = True  # see sample_elbo_weighted_mse
+        try:
+            for _ in range(sample_nbr):
+                outputs = self.forward_suffix(inputs_)
+                criterion_loss += criterion(
+                    outputs, labels, y_target
+                )  # use this for cosine
+                kldiverg_loss += self.nn_kl_divergence()
+        finally:
+            self.blinear1.complexity_cost = False
 
         criterion_loss = criterion_loss_weight * criterion_loss / sample_nbr
         kldiverg_loss = complexity_cost_weight * kldiverg_loss / sample_nbr
@@ -192,32 +543,63 @@ class BayesianRegressor(nn.Module):
     )
 
 
-def evaluate_regression(regressor, X, y, samples=15):
+# Half width of the central 95% interval of a Gaussian, in standard deviations
+COVERAGE_Z = 1.959964
+
+
+def evaluate_posterior(
+    regressor, X, y=None, samples=15, block_size=4096, correction=0, precision="float32"
+):
+    """Vectorised evaluation of the posterior predictive distribution: the rows of X
+    are processed in blocks, drawing the samples of each block in a single tensor
+    Parameters:
+        regressor: BayesianRegressor -> trained network
+        X: torch.tensor -> input rows, shape (N, input_dim)
+        y: torch.tensor -> targets, shape (N, output_dim). If None, only the predictive
+            mean and std are returned
+        samples: int -> number of posterior samples per row
+        block_size: int -> number of rows evaluated at once
+        correction: int -> std correction (0: population std as np.std, 1: sample std)
+        precision: str -> precision of the forward pass, 'float32' or 'bfloat16'
+            (autocast). The mean and std are always reduced in float32
+    Returns dict -> 'mean' and 'std' (np.array, shape (N, output_dim)) and, if y is
+        given, the per-output 'rmse', Gaussian 'nll' (mean over the rows) and 'coverage'
+        (fraction of targets inside the 95% predictive interval)
+    """
+    device = next(regressor.parameters()).device
+    p_mean = []
+    p_stdv = []
+    with torch.inference_mode():
+        for start in range(0, len(X), block_size):
+            x_ = X[start : start + block_size].to(device)
+            # the deterministic prefix is computed once for all the samples
+            with autocast(device, precision):
+                y_ = regressor.sample(x_, samples)
+            stdv, mean = torch.std_mean(y_.float(), dim=0, correction=correction)
+            p_mean.append(mean)
+            p_stdv.append(stdv)
+    mean = torch.cat(p_mean)
+    stdv = torch.cat(p_stdv)
+    result = {"mean": mean.cpu().numpy(), "std": stdv.cpu().numpy()}
+    if y is None:
+        return result
+
+    error = mean - y.to(device).reshape(mean.shape)
+    # a degenerate (zero) std would make the likelihood infinite
+    var = torch.clamp(stdv**2, min=torch.finfo(stdv.dtype).eps)
+    nll = 0.5 * (torch.log(2 * math.pi * var) + error**2 / var)
+    covered = (error.abs() <= COVERAGE_Z * stdv).float()
+    result["rmse"] = torch.sqrt(torch.mean(error**2, dim=0)).cpu().numpy()
+    result["nll"] = torch.mean(nll, dim=0).cpu().numpy()
+    result["coverage"] = torch.mean(covered, dim=0).cpu().numpy()
+    return result
 
-    # we need to draw k-samples for each x-input entry. Posterior sampling is done to obtain the E[y] over a Gaussian distribution
-    # The maximum likelihood estimates: meand & stdev of the sample vector (large enough for a good approximation)
-    # If sample vector is large enough biased and unbiased estimators will converge (samples >> 1)
-    errors = (
-        []
-    )  # list containing the error as e = y - E[f(x)] for all the x in X. y_pred = f(x)
-    # E[f(x)] is the expected value, computed as the mean(x) as the MLE for a Gaussian distribution (expected)
-    uncert = []
-    y_list = y.tolist()
-    for i in range(
-        len(X)
-    ):  # for each input x[i] (that should be the latent enconding of the image)
-        y_samples = []
-        for k in range(samples):  # draw k-samples.
-            y_tensor = regressor(X[i])
-            y_samples.append(
-                y_tensor[0].tolist()
-            )  # Each call to regressor(x = X[i]) will return a different value
-        e_y = statistics.mean(y_samples)  # mean(y_samples) as MLE for E[f(x)]
-        u_y = statistics.stdev(y_samples)  # mean(y_samples) as MLE for E[f(x)]
-        error = e_y - y_list[i][0]  # error = (expected - target)^2
-        errors.append(error * error)
-        uncert.append(u_y)
-
-    errors_mean = math.sqrt(statistics.mean(errors))  # single axis list, eq: (axis = 0)
-    uncert_mean = statistics.mean(uncert)
+
+def evaluate_regression(regressor, X, y, samples=15):
+    """Returns the RMSE of the predictive mean and the mean predictive uncertainty
+    (sample std) of the first output, over the rows of X"""
+    # The expected value E[f(x)] of each row is the mean of its posterior samples
+    evaluation = evaluate_posterior(regressor, X, y, samples=samples, correction=1)
+    errors_mean = float(evaluation["rmse"][0])
+    uncert_mean = float(np.mean(evaluation["std"][:, 0]))
     return errors_mean, uncert_mean
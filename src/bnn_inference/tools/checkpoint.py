@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import os
+import random
+import tempfile
+
+import numpy as np
+import torch
+
+from bnn_inference.tools.console import Console
+
+
+def rng_state():
+    """Returns the state of all the random generators used while training (Python,
+    numpy, torch and CUDA), so that a resumed run draws the same random numbers"""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restores the random generators from a state returned by rng_state"""
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_checkpoint(checkpoint, filename):
+    """Saves a training checkpoint atomically: the file is written next to the
+    destination and then renamed, so a run killed while saving never leaves a
+    truncated checkpoint behind. The temporary file is unique to each call, so runs
+    saving to the same checkpoint never write to the same file"""
+    fd, temporary_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=os.path.basename(filename) + ".",
+        suffix=".tmp",
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            torch.save(checkpoint, f)
+        os.replace(temporary_filename, filename)
+    except BaseException:
+        os.remove(temporary_filename)
+        raise
+
+
+def load_checkpoint(filename):
+    """Loads a training checkpoint saved with save_checkpoint (on the CPU, as the RNG
+    states must stay there). Returns None if there is no checkpoint"""
+    if not os.path.isfile(filename):
+        return None
+    Console.info("Loading checkpoint [", filename, "]")
+    # the checkpoint holds the RNG and optimizer states, not only tensors
+    return torch.load(filename, map_location="cpu", weights_only=False)
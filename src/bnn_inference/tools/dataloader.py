@@ -12,6 +12,8 @@ import numpy as np
 import pandas as pd
 
 from bnn_inference.tools.console import BColors, Console
+from bnn_inference.tools.latent_store import LatentStore, is_latent_store
+from bnn_inference.tools.table_io import filter_columns, read_table, table_columns
 
 
 class CustomDataloader:
@@ -29,27 +31,46 @@ class CustomDataloader:
         matching_key="relative_path",
         target_key_prefix="mean_slope",
         input_key_prefix="latent_",
+        return_report=False,
     ):
 
         # check if input_filename exists
-        if not os.path.isfile(input_filename):
+        if is_latent_store(input_filename):
+            # Binary store (see convert), already validated (NaN removed) at convert
+            # time. Only the metadata is read: the latent matrix stays memory-mapped
+            # and only the matched rows are gathered after the join
+            store = LatentStore(input_filename)
+            store.checkKey(input_key_prefix)
+            df = store.metadata()
+            latents = store.latents
+            latent_columns = store.latent_columns
+            Console.info("Input entries: ", len(df))
+        elif not os.path.isfile(input_filename):
             Console.quit("Input file does not exist: ", input_filename)
+        else:
+            # Read the header first, then parse only the matching key and the latent
+            # columns (as float32)
+            latent_columns = filter_columns(
+                table_columns(input_filename), input_key_prefix
+            )
+            df = read_table(
+                input_filename,
+                columns=[matching_key] + latent_columns,
+                dtype=dict.fromkeys(latent_columns, np.float32),
+            )  # remove index_col=0 when using toy dataset (otherwise it's used as df index and won't be available for query)
+            # df = pd.read_csv(input_filename, index_col=0) # use 1st column as ID, the 2nd (relative_path) can be used as part of UUID
 
-        df = pd.read_csv(
-            input_filename
-        )  # remove index_col=0 when using toy dataset (otherwise it's used as df index and won't be available for query)
-        # df = pd.read_csv(input_filename, index_col=0) # use 1st column as ID, the 2nd (relative_path) can be used as part of UUID
-
-        # 1) Data validation, remove invalid entries (e.g. NaN)
-        df = df.dropna()
-        # print (df.head()) # Enable for debug purposes
-        Console.info("Input entries (NaN removed): ", len(df))
+            # 1) Data validation, remove invalid entries (e.g. NaN)
+            df = df.dropna()
+            # print (df.head()) # Enable for debug purposes
+            Console.info("Input entries (NaN removed): ", len(df))
+            latents = df[latent_columns].to_numpy(dtype=np.float32)
 
         # 2) Let's determine number of latent-space dimensions
         # The number of 'features' are defined by those columns labeled as 'relative_path'xxx, where xx is 0-based index for the h-latent space vector
         # Example: (8 dimensions: h0, h1, ... , h7)
         # relative_path northing [m] easting [m] ... latitude [deg] longitude [deg] recon_loss h0 h1 h2 h3 h4 h5 h6 h7
-        n_latents = len(df.filter(regex=input_key_prefix).columns)
+        n_latents = len(latent_columns)
         Console.info("Input latent entries: ", n_latents)
 
         # If the number of latent dimensions is zero, show error message and exit
@@ -69,10 +90,6 @@ class CustomDataloader:
                 input_filename,
             )
             return
-        df["matching_key"] = df[
-            matching_key
-        ]  # create a new dataframe column with the matching key
-
         # 3) Key matching
         # each 'relative_path' entry has the format  slo/20181121_depthmap_1050_0251_no_slo.tif
         # where the filename is composed by [date_type_tilex_tiley_mod_type]. input and target tables differ only in 'type' field
@@ -85,8 +102,13 @@ class CustomDataloader:
         if not os.path.isfile(target_filename):
             Console.error("Target file does not exist: ", target_filename)
             return
-        tdf = pd.read_csv(
-            target_filename
+        target_columns = filter_columns(
+            table_columns(target_filename), target_key_prefix
+        )
+        tdf = read_table(
+            target_filename,
+            columns=[matching_key] + target_columns,
+            dtype=dict.fromkeys(target_columns, np.float32),
         )  # expected header: relative_path	mean_slope [ ... ] mean_rugosity
         tdf = tdf.dropna()
 
@@ -105,35 +127,108 @@ class CustomDataloader:
         if matching_key not in tdf.columns:
             Console.error("Matching key not found in target file: ", matching_key)
             return
-        tdf["matching_key"] = tdf[
-            matching_key
-        ]  # create the dataframe containing the target values
         ###############################################
 
         Console.info("Total loaded targets(y): ", len(tdf))
 
-        merged_df = pd.merge(
-            df, tdf, how="right", on="matching_key"
-        )  # join on right, so that we can use the target values
-        merged_df = (
-            merged_df.dropna()
-        )  # drop any stray NaN values. There should be none
-
-        latent_df = merged_df.filter(
-            regex=input_key_prefix
-        )  # remove all columns not starting with input_key_prefix ('latent_')
-        Console.info("Latent vector list (after filter): ", latent_df.shape)
-
-        # print ("merged_df: ", latent_df.head())
-
-        target_df = merged_df.filter(
-            regex=target_key_prefix
-        )  # remove all columns not starting with input_key_prefix ('latent_')
-        #        target_df = merged_df[target_key_prefix]
-        # latent_np = latent_df.to_numpy(dtype=np.float64)   # Explicit numeric data conversion to avoid silent bugs with implicit string conversion
-        # target_np = target_df.to_numpy(dtype=np.float64)   # Apply to both target and latent data
+        # 4) Join on the matching key through integer codes, gathering the aligned
+        # rows directly (as a right join: one pair per target and matching input)
+        input_rows, target_rows, report = CustomDataloader.join_keys(
+            df[matching_key], tdf[matching_key]
+        )
+        CustomDataloader.print_report(report)
+
+        # The aligned arrays are wrapped (not copied) in dataframes to keep the names.
+        # Only the matched latent rows are gathered (from the memory map of a store)
+        latent_df = pd.DataFrame(
+            np.asarray(latents[input_rows], dtype=np.float32), columns=latent_columns
+        )
+        Console.info("Latent vector list (after join): ", latent_df.shape)
+        target_df = tdf.filter(regex=target_key_prefix)
+        target_df = pd.DataFrame(
+            target_df.to_numpy(dtype=np.float32)[target_rows], columns=target_df.columns
+        )
+        uuid = pd.Series(tdf[matching_key].to_numpy()[target_rows], name=matching_key)
         # input-output datasets are linked using the key provided by matching_key
-        return latent_df, target_df, merged_df["matching_key"]
+        if return_report:
+            return latent_df, target_df, uuid, report
+        return latent_df, target_df, uuid
+
+    def join_keys(input_keys, target_keys):
+        """
+        Matches the input and target keys (e.g. relative_path) with the same result as
+        a right join: one pair for each target key and input row with that key, in
+        the order of the targets. Both key lists are interned into integer codes with
+        a single hash pass, so no merged table is built.
+
+        Parameters:
+            input_keys: pd.Series -> keys of the input (latent) rows
+            target_keys: pd.Series -> keys of the target rows
+
+        Returns:
+            input_rows: np.ndarray -> input row of each pair
+            target_rows: np.ndarray -> target row of each pair
+            report: dict -> number of matched, unmatched and duplicated keys
+        """
+        n_inputs = len(input_keys)
+        codes, uniques = pd.concat(
+            [pd.Series(input_keys), pd.Series(target_keys)], ignore_index=True
+        ).factorize()
+        # Missing keys match each other (as in a join): they get a code of their own
+        n_codes = len(uniques) + 1
+        codes[codes < 0] = n_codes - 1
+        input_codes, target_codes = codes[:n_inputs], codes[n_inputs:]
+        input_counts = np.bincount(input_codes, minlength=n_codes)
+        target_counts = np.bincount(target_codes, minlength=n_codes)
+
+        # input rows grouped by key code: those of code c start at starts[c]
+        order = np.argsort(input_codes, kind="stable")
+        starts = np.cumsum(input_counts) - input_counts
+        n_matches = input_counts[target_codes]  # matching inputs of each target row
+        target_rows = np.repeat(np.arange(len(target_keys)), n_matches)
+        rank = np.arange(len(target_rows)) - np.repeat(
+            np.cumsum(n_matches) - n_matches, n_matches
+        )
+        input_rows = order[starts[target_codes][target_rows] + rank]
+
+        report = {
+            "input_rows": n_inputs,
+            "target_rows": len(target_keys),
+            "pairs": len(target_rows),
+            "unmatched_targets": int(np.count_nonzero(n_matches == 0)),
+            "unmatched_inputs": int(np.count_nonzero(target_counts[input_codes] == 0)),
+            "duplicated_input_keys": int(np.count_nonzero(input_counts > 1)),
+            "duplicated_target_keys": int(np.count_nonzero(target_counts > 1)),
+        }
+        return input_rows, target_rows, report
+
+    def print_report(report):
+        """Prints the match report of join_keys"""
+        Console.info(
+            "Matched pairs: ",
+            report["pairs"],
+            "(from",
+            report["input_rows"],
+            "inputs and",
+            report["target_rows"],
+            "targets)",
+        )
+        if report["unmatched_targets"] > 0 or report["unmatched_inputs"] > 0:
+            Console.warn(
+                "Unmatched rows:",
+                report["unmatched_targets"],
+                "targets without input,",
+                report["unmatched_inputs"],
+                "inputs without target",
+            )
+        if report["duplicated_input_keys"] > 0 or report["duplicated_target_keys"] > 0:
+            Console.warn(
+                "Duplicated keys:",
+                report["duplicated_input_keys"],
+                "in the input file,",
+                report["duplicated_target_keys"],
+                "in the target file. Each target is paired with every matching input",
+            )
 
     def load_toydataset(
         input_filename,
@@ -143,28 +238,42 @@ class CustomDataloader:
     ):
         Console.info("load_toydataset called for: ", input_filename)
 
-        df = pd.read_csv(
-            input_filename, index_col=0
-        )  # use 1st column as ID, the 2nd (relative_path) can be used as part of UUID
-        # 1) Data validation, remove invalid entries (e.g. NaN)
-        print(df.head())
-        df = df.dropna()
-        Console.info("Total valid entries: ", len(df))
-        # df.reset)index(drop = True) # not sure if we prefer to reset index, as column index was externallly defined
+        if is_latent_store(input_filename):
+            # Binary store (see convert), already validated (NaN removed) at convert
+            # time: the latent matrix is used through its memory map, without copies
+            store = LatentStore(input_filename)
+            store.checkKey(input_prefix)
+            df = store.metadata()
+            Console.info("Total valid entries: ", len(df))
+            latent_columns = store.latent_columns
+            latent_np = store.latents
+        else:
+            # Parse only the UUID, target and latent columns (as float32)
+            latent_columns = filter_columns(table_columns(input_filename), input_prefix)
+            df = read_table(
+                input_filename,
+                columns=[matching_key, target_key_prefix] + latent_columns,
+                index_col=0,
+                dtype=dict.fromkeys(latent_columns + [target_key_prefix], np.float32),
+            )  # use 1st column as ID, the 2nd (relative_path) can be used as part of UUID
+            # 1) Data validation, remove invalid entries (e.g. NaN)
+            print(df.head())
+            df = df.dropna()
+            Console.info("Total valid entries: ", len(df))
+            # df.reset)index(drop = True) # not sure if we prefer to reset index, as column index was externallly defined
+            latent_np = df[latent_columns].to_numpy(dtype=np.float32)
 
         # 2) Let's determine number of latent-space dimensions
         # The number of 'features' are defined by those columns labeled as 'relative_path'xxx, where xx is 0-based index for the h-latent space vector
         # Example: (8 dimensions: h0, h1, ... , h7)
         # relative_path northing [m] easting [m] ... latitude [deg] longitude [deg] recon_loss h0 h1 h2 h3 h4 h5 h6 h7
-        n_latents = len(df.filter(regex=input_prefix).columns)
+        n_latents = len(latent_columns)
         Console.info("Latent dimensions: ", n_latents)
 
-        latent_df = df.filter(regex=input_prefix)
         target_df = df[target_key_prefix]
-        Console.info("Latent size: ", latent_df.shape)
+        Console.info("Latent size: ", latent_np.shape)
 
-        latent_np = latent_df.to_numpy(dtype=np.float64)
-        target_np = target_df.to_numpy(dtype=np.float64)
+        target_np = target_df.to_numpy(dtype=np.float32)
         uuid_np = df[
             matching_key
         ].to_numpy()  # UUIDs are retrieved from the matching_key column
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from bnn_inference.tools.console import Console
+
+
+def file_fingerprint(path):
+    """Returns the size, modification time and content hash of a file. For a
+    directory (e.g. a latent store), those of each of its files"""
+    if os.path.isdir(path):
+        return {
+            name: file_fingerprint(os.path.join(path, name))
+            for name in sorted(os.listdir(path))
+        }
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "hash": digest.hexdigest(),
+    }
+
+
+class DatasetCache:
+    """
+    On-disk cache of the joined training dataset (latent matrix, targets and UUIDs),
+    so that repeated training runs on the same files skip the parsing and the join.
+    Each combination of input/target files and keys has one entry (.npz file) in the
+    cache directory. The entry stores the fingerprint of the files (size, mtime and
+    content hash), and it is rebuilt when any of them changes.
+    """
+
+    def __init__(self, cache_path, input_filenames, keys):
+        self.input_filenames = input_filenames
+        self.keys = keys
+        # Entry name: absolute paths of the files and keys used for the join
+        slot = hashlib.sha1(
+            json.dumps(
+                [[os.path.abspath(f) for f in input_filenames], keys], sort_keys=True
+            ).encode()
+        ).hexdigest()
+        os.makedirs(cache_path, exist_ok=True)
+        self.cache_path = cache_path
+        self.entry_filename = os.path.join(cache_path, slot + ".npz")
+        self.fingerprint = json.dumps(
+            [file_fingerprint(f) for f in input_filenames], sort_keys=True
+        )
+
+    def load(self):
+        """Returns the cached (X, y, uuid) dataframes, or None if there is no valid
+        entry for the current files"""
+        if not os.path.isfile(self.entry_filename):
+            return None
+        with np.load(self.entry_filename) as entry:
+            if str(entry["fingerprint"]) != self.fingerprint:
+                Console.info("Input files changed, rebuilding the dataset cache")
+                return None
+            try:
+                uuid = entry["uuid"]
+            except ValueError:  # object array, written by an older version
+                uuid = None
+            if uuid is None or "uuid_dtype" not in entry.files:
+                Console.info("Outdated dataset cache entry, rebuilding it")
+                return None
+            X_df = pd.DataFrame(entry["X"], columns=entry["latent_columns"])
+            y_df = pd.DataFrame(entry["y"], columns=entry["target_columns"])
+            # the keys are cast back to their dtype, so a hit returns the same as a miss
+            uuid = pd.Series(uuid, name=self.keys["uuid_key"]).astype(
+                str(entry["uuid_dtype"])
+            )
+        Console.info("Dataset loaded from cache [", self.entry_filename, "]")
+        return X_df, y_df, uuid
+
+    def store(self, X_df, y_df, uuid):
+        """Stores the joined dataset, replacing the previous entry"""
+        uuid_values = uuid.to_numpy()
+        if uuid_values.dtype == object:
+            # text keys are stored as a fixed-width string array (nothing pickled)
+            uuid_values = uuid_values.astype(str)
+        # Each run writes its own temporary file, renamed when complete: concurrent
+        # runs never read (or write to) a partially written entry
+        fd, temporary_filename = tempfile.mkstemp(dir=self.cache_path, suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    X=X_df.to_numpy(dtype=np.float32),
+                    y=y_df.to_numpy(dtype=np.float32),
+                    uuid=uuid_values,
+                    uuid_dtype=np.array(str(uuid.dtype)),
+                    latent_columns=np.array(X_df.columns, dtype=str),
+                    target_columns=np.array(y_df.columns, dtype=str),
+                    fingerprint=np.array(self.fingerprint),
+                )
+            os.replace(temporary_filename, self.entry_filename)
+        except BaseException:
+            os.remove(temporary_filename)
+            raise
+        Console.info("Dataset cached to [", self.entry_filename, "]")
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from bnn_inference.tools.console import Console
+from bnn_inference.tools.table_io import read_table, write_table
+
+# A latent store is a directory with:
+#   manifest.yaml   -> number of rows, latent columns, source file, ...
+#   latents.npy     -> float32 (N, n_latents) matrix of latent vectors
+#   metadata.<ext>  -> all the other columns (UUIDs, coordinates, ...) and the index
+MANIFEST_FILENAME = "manifest.yaml"
+LATENTS_FILENAME = "latents.npy"
+
+
+def is_latent_store(path):
+    """Returns True if path is a latent store created by convert"""
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, MANIFEST_FILENAME))
+
+
+def convert_latents(input_filename, input_key_prefix, output_path):
+    """Converts a latent table (CSV, Parquet, Arrow) into a latent store. Rows with
+    invalid entries (NaN) are removed, as the loaders would do
+
+    Returns the manifest dictionary"""
+    df = read_table(input_filename, index_col=0)
+    n_total = len(df)
+    df = df.dropna()
+    latent_columns = list(df.filter(regex=input_key_prefix).columns)
+    if len(latent_columns) == 0:
+        Console.quit("No columns matching the input_key [", input_key_prefix, "] found")
+    metadata_columns = [c for c in df.columns if c not in latent_columns]
+
+    os.makedirs(output_path, exist_ok=True)
+    latents = np.ascontiguousarray(df[latent_columns].to_numpy(dtype=np.float32))
+    np.save(os.path.join(output_path, LATENTS_FILENAME), latents)
+    # The sidecar keeps the typed metadata columns; Parquet when pyarrow is available
+    try:
+        import pyarrow  # noqa: F401
+
+        metadata_filename = "metadata.parquet"
+    except ImportError:
+        metadata_filename = "metadata.csv"
+    write_table(df[metadata_columns], os.path.join(output_path, metadata_filename))
+
+    stat = os.stat(input_filename)
+    manifest = {
+        "source_filename": os.path.abspath(input_filename),
+        "source_size": stat.st_size,
+        "source_mtime": stat.st_mtime,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "num_rows": len(df),
+        "num_dropped_rows": n_total - len(df),
+        "latent_key": input_key_prefix,
+        "latent_columns": latent_columns,
+        "latents_filename": LATENTS_FILENAME,
+        "latents_dtype": "float32",
+        "metadata_filename": metadata_filename,
+        "metadata_columns": metadata_columns,
+        "index_name": df.index.name,
+    }
+    with open(os.path.join(output_path, MANIFEST_FILENAME), "w") as f:
+        yaml.dump(manifest, f, sort_keys=False)
+    return manifest
+
+
+class LatentStore:
+    """
+    Read access to a latent store. The latent matrix is memory-mapped (read-only), so
+    it is loaded lazily, without copies, and shared through the OS page cache by the
+    jobs reading the same store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILENAME), "r") as f:
+            self.manifest = yaml.safe_load(f)
+        self.latents = np.load(
+            os.path.join(path, self.manifest["latents_filename"]), mmap_mode="r"
+        )
+        self.latent_columns = self.manifest["latent_columns"]
+
+        source = self.manifest["source_filename"]
+        if os.path.isfile(source) and (
+            os.stat(source).st_size != self.manifest["source_size"]
+            or os.stat(source).st_mtime != self.manifest["source_mtime"]
+        ):
+            Console.warn(
+                "The source file [", source, "] changed after creating the latent store"
+            )
+
+    def checkKey(self, input_key_prefix):
+        """Warns if the store was created for a different latent key"""
+        if input_key_prefix != self.manifest["latent_key"]:
+            Console.warn(
+                "Latent store created with latent key [",
+                self.manifest["latent_key"],
+                "], ignoring [",
+                input_key_prefix,
+                "]",
+            )
+
+    def metadata(self):
+        """Returns the metadata (non latent) columns, indexed as the source table"""
+        df = read_table(
+            os.path.join(self.path, self.manifest["metadata_filename"]), index_col=0
+        )
+        df.index.name = self.manifest["index_name"]
+        return df
+
+    def dataframe(self):
+        """Returns the whole table (metadata and latent columns) as a dataframe. Unlike
+        the latent matrix, it is a copy in memory"""
+        df = self.metadata()
+        latent_df = pd.DataFrame(
+            self.latents, index=df.index, columns=self.latent_columns
+        )
+        return pd.concat([df, latent_df], axis=1)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+
+import numpy as np
+
+from bnn_inference.tools.console import Console
+
+
+class PredictionCache:
+    """
+    On-disk (SQLite) cache of predicted rows. Each entry is addressed by the hash of
+    the network file, the inference settings and the latent vector of the row, so any
+    change in the network or settings gives new keys. The least recently used entries
+    are evicted when the cache grows above max_size_mb.
+    """
+
+    # Number of keys per SELECT statement (below the SQLite parameter limit)
+    QUERY_SIZE = 500
+
+    def __init__(self, cache_filename, network_filename, settings, max_size_mb=1024):
+        self.cache_filename = cache_filename
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+
+        # Prefix shared by all the keys: network file contents and settings
+        digest = hashlib.sha1()
+        with open(network_filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        self.prefix = digest.digest()
+
+        self.db = sqlite3.connect(cache_filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "key BLOB PRIMARY KEY, mean BLOB, std BLOB, n_samples INTEGER, "
+            "last_used REAL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS predictions_last_used "
+            "ON predictions (last_used)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)"
+        )
+        self.db.commit()
+
+    def rowKeys(self, X):
+        """Returns the cache key of each row of X (latent vectors)"""
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        return [
+            hashlib.blake2b(self.prefix + row.tobytes(), digest_size=16).digest()
+            for row in X
+        ]
+
+    def lookup(self, keys, output_dim):
+        """Looks up the keys in the cache
+
+        Returns the mask of cached rows and their mean, std and number of samples
+        (only valid where the mask is True)"""
+        n_rows = len(keys)
+        found = np.zeros(n_rows, dtype=bool)
+        mean = np.zeros((n_rows, output_dim))
+        stdv = np.zeros((n_rows, output_dim))
+        n_samples = np.zeros(n_rows, dtype=np.int64)
+        position = {key: i for i, key in enumerate(keys)}
+        for start in range(0, n_rows, self.QUERY_SIZE):
+            block = keys[start : start + self.QUERY_SIZE]
+            rows = self.db.execute(
+                "SELECT key, mean, std, n_samples FROM predictions WHERE key IN ("
+                + ",".join("?" * len(block))
+                + ")",
+                block,
+            )
+            for key, row_mean, row_stdv, row_n_samples in rows:
+                i = position[key]
+                found[i] = True
+                mean[i] = np.frombuffer(row_mean, dtype=np.float64)
+                stdv[i] = np.frombuffer(row_stdv, dtype=np.float64)
+                n_samples[i] = row_n_samples
+        # Refresh the last use of the hits, so they are evicted last
+        now = time.time()
+        self.db.executemany(
+            "UPDATE predictions SET last_used = ? WHERE key = ?",
+            [(now, keys[i]) for i in np.flatnonzero(found)],
+        )
+        self.db.commit()
+        self.hits += int(found.sum())
+        self.misses += n_rows - int(found.sum())
+        return found, mean, stdv, n_samples
+
+    def store(self, keys, mean, stdv, n_samples):
+        """Stores the (unscaled) predictions of the given keys"""
+        now = time.time()
+        mean = np.asarray(mean, dtype=np.float64)
+        stdv = np.asarray(stdv, dtype=np.float64)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)",
+            [
+                (keys[i], mean[i].tobytes(), stdv[i].tobytes(), int(n_samples[i]), now)
+                for i in range(len(keys))
+            ],
+        )
+        self.db.commit()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is below its
+        maximum size. Returns the number of removed entries"""
+        n_entries = self.db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        size = (
+            self.db.execute("PRAGMA page_count").fetchone()[0]
+            * self.db.execute("PRAGMA page_size").fetchone()[0]
+        )
+        if size <= self.max_size or n_entries == 0:
+            return 0
+        # Remove the same fraction of entries as the size in excess (file size)
+        n_evict = int(np.ceil(n_entries * (size - self.max_size) / size))
+        self.db.execute(
+            "DELETE FROM predictions WHERE key IN (SELECT key FROM predictions "
+            "ORDER BY last_used LIMIT ?)",
+            (n_evict,),
+        )
+        self.db.commit()
+        self.db.execute("VACUUM")
+        return n_evict
+
+    def close(self):
+        """Evicts the old entries, updates the overall statistics and closes the cache
+
+        Returns the statistics dictionary"""
+        evicted = self.evict()
+        for name, value in (
+            ("hits", self.hits),
+            ("misses", self.misses),
+            ("evicted", evicted),
+        ):
+            self.db.execute(
+                "INSERT INTO stats VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, value),
+            )
+        self.db.commit()
+        stats = dict(self.db.execute("SELECT name, value FROM stats").fetchall())
+        stats["entries"] = self.db.execute(
+            "SELECT COUNT(*) FROM predictions"
+        ).fetchone()[0]
+        self.db.close()
+        Console.info(
+            "Prediction cache: {} hits, {} misses ({:.1%} hit rate), {} evicted, "
+            "{} entries".format(
+                self.hits,
+                self.misses,
+                self.hits / max(self.hits + self.misses, 1),
+                evicted,
+                stats["entries"],
+            )
+        )
+        return stats
@@ -6,13 +6,30 @@ Licensed under the BSD 3-Clause License.
 See LICENSE.md file in the project root for full license information.
 """
 
+import hashlib
+import math
+import multiprocessing
 import os
 import timeit
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import pandas as pd
+import torch
 
 from bnn_inference.tools.console import BColors, Console
+from bnn_inference.tools.latent_store import LatentStore, is_latent_store
+from bnn_inference.tools.scripted_predictor import load_scripted
+from bnn_inference.tools.table_io import (
+    filter_columns,
+    iter_table,
+    read_table,
+    table_columns,
+)
+from bnn_inference.tools.utilities import (
+    CompiledFunction,
+    autocast,
+    report_call_times,
+)
 
 
 class PredictiveEngine:
@@ -22,29 +39,348 @@ class PredictiveEngine:
     def loadData(input_filename, input_key_prefix="latent_"):
         Console.info("PredictiveEngine.predict called for: ", input_filename)
 
+        if is_latent_store(input_filename):
+            # Binary store (see convert): the latent matrix is memory-mapped (float32)
+            store = LatentStore(input_filename)
+            store.checkKey(input_key_prefix)
+            np_latent = store.latents
+            Console.info("Total valid entries: ", len(np_latent))
+            Console.info("Latent dimensions: ", np_latent.shape[1])
+            return np_latent, np_latent.shape[1], store.metadata()
+
         # Check if input_filename exists
         if not os.path.isfile(input_filename):
             Console.error("Input file does not exist: ", input_filename)
             return
-        df = pd.read_csv(
-            input_filename, index_col=0
-        )  # use 1st column as ID, the 2nd (relative_path) can be used as part of UUID
-        # 1) Data validation, remove invalid entries (e.g. NaN)
-        # print (df.head())
-        df = df.dropna()
-        Console.info("Total valid entries: ", len(df))
-        # 2) Let's determine number of latent-space dimensions
+        # 1) Let's determine number of latent-space dimensions from the header, so
+        # that the latent columns are parsed directly as float32
         # The number of 'features' are defined by those columns labeled as 'relative_path'xxx, where xx is 0-based index for the h-latent space vector
         # Example: (8 dimensions: h0, h1, ... , h7)
         # relative_path northing [m] easting [m] ... latitude [deg] longitude [deg] recon_loss h0 h1 h2 h3 h4 h5 h6 h7
-        n_latents = len(df.filter(regex=input_key_prefix).columns)
+        latent_columns = filter_columns(table_columns(input_filename), input_key_prefix)
+        n_latents = len(latent_columns)
         Console.info("Latent dimensions: ", n_latents)
+        df = read_table(
+            input_filename,
+            index_col=0,
+            dtype=dict.fromkeys(latent_columns, np.float32),
+        )  # use 1st column as ID, the 2nd (relative_path) can be used as part of UUID
+        # 2) Data validation, remove invalid entries (e.g. NaN)
+        # print (df.head())
+        df = df.dropna()
+        Console.info("Total valid entries: ", len(df))
+
+        np_latent = df[latent_columns].to_numpy(dtype=np.float32)
+        Console.info("Latent size: ", np_latent.shape)
+        # The latent vectors are not exported, no need to keep a second copy
+        return np_latent, n_latents, df.drop(columns=latent_columns)
+
+    def iterData(input_filename, input_key_prefix="latent_", chunk_size=100000):
+        """Streaming version of loadData. Reads the input file chunk_size rows at a
+        time and yields the same (np_latent, n_latents, df) tuple for each chunk,
+        so that the memory footprint is bounded by the chunk size"""
+        Console.info("PredictiveEngine.iterData called for: ", input_filename)
+
+        if is_latent_store(input_filename):
+            store = LatentStore(input_filename)
+            store.checkKey(input_key_prefix)
+            df = store.metadata()
+            for start in range(0, len(df), chunk_size):
+                np_latent = store.latents[start : start + chunk_size]
+                yield np_latent, np_latent.shape[1], df.iloc[start : start + chunk_size]
+            return
+
+        # Check if input_filename exists
+        if not os.path.isfile(input_filename):
+            Console.error("Input file does not exist: ", input_filename)
+            return
+        latent_columns = filter_columns(table_columns(input_filename), input_key_prefix)
+        reader = iter_table(
+            input_filename,
+            chunk_size,
+            index_col=0,
+            dtype=dict.fromkeys(latent_columns, np.float32),
+        )  # use 1st column as ID, the 2nd (relative_path) can be used as part of UUID
+        for df in reader:
+            # Data validation, remove invalid entries (e.g. NaN)
+            df = df.dropna()
+            np_latent = df[latent_columns].to_numpy(dtype=np.float32)
+            yield np_latent, len(latent_columns), df.drop(columns=latent_columns)
+
+    def loadNetwork(network_filename, n_latents, output_layer_type, device):
+        """Loads a trained network dictionary (as exported by train) and rebuilds the
+        BayesianRegressor in eval mode on the requested device. If n_latents is None,
+        the input dimension is taken from the network
+
+        Returns the regressor and the loaded dictionary"""
+        # blitz is only needed to rebuild the full network (see also loadScripted)
+        from bnn_inference.tools.bnn_model import BayesianRegressor
+
+        trained_network = torch.load(
+            network_filename, map_location=device
+        )  # load pretrained model (dictionary)
+        if n_latents is None:
+            n_latents = trained_network["model_state_dict"][
+                "linear_input.weight"
+            ].shape[1]
+        # we need to determine the number of outputs by looking at the linear_output layer
+        output_size = len(trained_network["model_state_dict"]["linear_output.weight"])
+        regressor = BayesianRegressor(
+            input_dim=n_latents,
+            output_dim=output_size,
+            output_type=output_layer_type,
+            bayesian_layer=trained_network.get("bayesian_layer", "blitz"),
+        ).to(device)
+        regressor.load_state_dict(
+            trained_network["model_state_dict"]
+        )  # load state from deserialized object
+        regressor.eval()  # switch to inference mode (set dropout layers)
+        return regressor, trained_network
+
+    def loadScripted(network_filename, n_latents, device):
+        """Loads a predictor exported with the export command (TorchScript). It runs
+        without blitz or the training dictionary, and supports the same sample() API
+        as the BayesianRegressor
+
+        Returns the scripted predictor and its metadata dictionary"""
+        predictor, metadata = load_scripted(network_filename, device)
+        if n_latents is not None and metadata["input_dim"] != n_latents:
+            Console.quit(
+                "The exported predictor expects",
+                metadata["input_dim"],
+                "latent dimensions, but the input has",
+                n_latents,
+            )
+        return predictor, metadata
+
+    def loadWeightBank(regressor, num_samples, seed=0, bank_filename=""):
+        """Returns a weight-sample bank of num_samples posterior draws of the Bayesian
+        layer. If bank_filename is provided, a previously stored bank is reused when it
+        matches the network, number of samples and seed; otherwise a new bank is drawn
+        and stored there"""
+        # Fingerprint of the posterior parameters, to detect banks of other networks
+        digest = hashlib.sha1()
+        for name in ("weight_mu", "weight_rho", "bias_mu", "bias_rho"):
+            tensor = getattr(regressor.blinear1, name).detach().cpu().contiguous()
+            digest.update(tensor.numpy().tobytes())
+        fingerprint = digest.hexdigest()
+
+        if bank_filename and os.path.isfile(bank_filename):
+            stored = torch.load(bank_filename, map_location="cpu")
+            if (
+                stored.get("fingerprint") == fingerprint
+                and stored.get("num_samples") == num_samples
+                and stored.get("seed") == seed
+            ):
+                Console.info("Using weight-sample bank [", bank_filename, "]")
+                return {"weight": stored["weight"], "bias": stored["bias"]}
+            Console.warn(
+                "Weight-sample bank [",
+                bank_filename,
+                "] does not match the network or sampling settings. Drawing a new one",
+            )
+
+        Console.info("Drawing weight-sample bank:", num_samples, "samples, seed", seed)
+        bank = regressor.draw_weight_bank(num_samples, seed=seed)
+        if bank_filename:
+            Console.info("Storing weight-sample bank [", bank_filename, "]")
+            torch.save(
+                {
+                    "fingerprint": fingerprint,
+                    "num_samples": num_samples,
+                    "seed": seed,
+                    "weight": bank["weight"],
+                    "bias": bank["bias"],
+                },
+                bank_filename,
+            )
+        return bank
+
+    @staticmethod
+    def predict(
+        regressor,
+        X,
+        num_samples,
+        block_size=4096,
+        device=None,
+        progress=True,
+        uncertainty_mode="mc",
+        bank=None,
+        max_samples=100,
+        tolerance=0.01,
+        precision="float32",
+    ):
+        """Draws num_samples posterior predictions for every row of X and reduces
+        them to their mean and standard deviation.
 
-        latent_df = df.filter(regex=input_key_prefix)
-        Console.info("Latent size: ", latent_df.shape)
+        Rows are processed in blocks of block_size: each posterior draw is a single
+        forward pass over the whole block, and the K draws are stacked and reduced
+        on the device. This replaces the per-row, per-sample loop (N x K forward
+        passes) with ceil(N / block_size) x K passes.
 
-        np_latent = latent_df.to_numpy(dtype=np.float64)
-        return np_latent, n_latents, df
+        With uncertainty_mode 'moments' no samples are drawn: the predictive mean and
+        standard deviation are approximated in a single deterministic pass by
+        propagating the moments of the posterior (see forward_moments). With 'bank'
+        every row is evaluated against the same K pre-drawn weight samples (see
+        loadWeightBank), so results are reproducible across runs. With 'adaptive'
+        each row draws at least num_samples and at most max_samples samples, until its
+        mean and standard deviation converge within tolerance (see sampleAdaptive)
+
+        Parameters
+        ----------
+        regressor : BayesianRegressor
+            Trained network, already moved to device and set to eval mode
+        X : np.ndarray
+            Input (latent) matrix of shape (N, n_latents)
+        num_samples : int
+            Number of posterior samples (K) drawn for each row
+        block_size : int
+            Number of rows evaluated per forward pass, by default 4096
+        device : torch.device
+            Device used for inference, by default the CPU
+        progress : bool
+            Show a progress bar in the console, by default True
+        uncertainty_mode : str
+            'mc' (Monte Carlo sampling), 'moments' (moment propagation) or 'bank'
+            (weight-sample bank), by default 'mc'
+        bank : dict
+            Weight-sample bank, required by the 'bank' mode
+        max_samples : int
+            Maximum number of samples per row in the 'adaptive' mode, by default 100
+        tolerance : float
+            Convergence tolerance of the 'adaptive' mode (output units), by default 0.01
+        precision : str
+            Precision of the forward pass: 'float32' or 'bfloat16' (autocast, see
+            utilities.autocast), by default 'float32'. The samples are reduced in
+            float32, and the 'moments' mode always runs in float32
+
+        Returns
+        -------
+        tuple(np.ndarray, np.ndarray, np.ndarray)
+            Mean and (population) standard deviation of the samples, each of shape
+            (N, output_dim), and number of samples drawn for each row, shape (N,)
+        """
+        if device is None:
+            device = torch.device("cpu")
+        if bank is not None:
+            bank = {key: value.to(device) for key, value in bank.items()}
+        n_rows = X.shape[0]
+        p_mean = []
+        p_stdv = []
+        p_count = []
+        if uncertainty_mode == "moments":
+            precision = "float32"  # the propagated variances need the full precision
+        with torch.inference_mode(), autocast(device, precision):
+            for start in range(0, n_rows, block_size):
+                # copy of the block, as X can be a read-only memory map (latent store)
+                x_ = torch.tensor(
+                    X[start : start + block_size], dtype=torch.float32, device=device
+                )
+                count = torch.full((len(x_),), num_samples)
+                if uncertainty_mode == "moments":
+                    mean, var = regressor.forward_moments(x_)
+                    stdv = torch.sqrt(var)
+                    count.zero_()  # no samples are drawn
+                elif uncertainty_mode == "adaptive":
+                    mean, stdv, count = PredictiveEngine.sampleAdaptive(
+                        regressor, x_, num_samples, max_samples, tolerance
+                    )
+                elif uncertainty_mode == "bank":
+                    # All the K weight samples are evaluated in a single batched matmul
+                    y_ = regressor.forward_bank(x_, bank).float()
+                    stdv, mean = torch.std_mean(y_, dim=0, correction=0)
+                else:
+                    # Every posterior sample draws a new set of weights for the whole
+                    # block, the deterministic prefix of the network is computed once
+                    y_ = regressor.sample(x_, num_samples).float()
+                    # np.std default (ddof=0) is the population standard deviation
+                    stdv, mean = torch.std_mean(y_, dim=0, correction=0)
+                p_mean.append(mean.cpu().numpy())
+                p_stdv.append(stdv.cpu().numpy())
+                p_count.append(count.cpu().numpy())
+                if progress:
+                    Console.progress(min(start + block_size, n_rows), n_rows)
+        if n_rows == 0:
+            output_dim = regressor.linear_output.out_features
+            return (
+                np.empty((0, output_dim)),
+                np.empty((0, output_dim)),
+                np.empty((0,), dtype=np.int64),
+            )
+        return np.concatenate(p_mean), np.concatenate(p_stdv), np.concatenate(p_count)
+
+    @staticmethod
+    def compileSampling(regressor):
+        """Compiles (torch.compile) the batched sampling methods of the network, used by
+        the 'mc' and 'bank' modes (sample and forward_bank). Returns the compiled
+        functions (see utilities.CompiledFunction), to report their timings"""
+        compiled = []
+        for name in ["sample", "forward_bank"]:
+            function = CompiledFunction(getattr(regressor, name), name)
+            setattr(regressor, name, function)
+            compiled.append(function)
+        return compiled
+
+    @staticmethod
+    def precisionDelta(regressor, X, num_samples, precision, device=None, **options):
+        """Maximum absolute difference of the predicted mean and standard deviation of
+        the rows of X in the given precision, against float32. Both predictions draw the
+        same posterior samples (same random seed), so the difference is only due to the
+        precision"""
+        predictions = []
+        for prediction_precision in (precision, "float32"):
+            with torch.random.fork_rng():
+                torch.manual_seed(0)
+                mean, stdv, _ = PredictiveEngine.predict(
+                    regressor,
+                    X,
+                    num_samples,
+                    device=device,
+                    progress=False,
+                    precision=prediction_precision,
+                    **options,
+                )
+            predictions.append((mean, stdv))
+        (mean, stdv), (reference_mean, reference_stdv) = predictions
+        return (
+            np.amax(np.abs(mean - reference_mean)),
+            np.amax(np.abs(stdv - reference_stdv)),
+        )
+
+    @staticmethod
+    def sampleAdaptive(regressor, x, min_samples, max_samples, tolerance):
+        """Adaptive Monte Carlo sampling for an input block x. Mean and variance are
+        accumulated online (Welford), and only the rows that have not converged are
+        sampled again. A row converges, after min_samples, when the standard error of
+        both its mean and its standard deviation are below tolerance for every output,
+        or when it reaches max_samples
+
+        Returns the mean and (population) standard deviation, shape (N, output_dim),
+        and the number of samples drawn for each row, shape (N,)"""
+        x_ = regressor.forward_prefix(x)  # deterministic prefix, computed only once
+        n_rows = x_.shape[0]
+        output_dim = regressor.linear_output.out_features
+        mean = torch.zeros((n_rows, output_dim), device=x_.device)
+        m2 = torch.zeros((n_rows, output_dim), device=x_.device)
+        count = torch.full((n_rows,), max(min_samples, max_samples), device=x_.device)
+        active = torch.arange(n_rows, device=x_.device)  # rows still being sampled
+        k = 0
+        while len(active) > 0 and k < max(min_samples, max_samples):
+            k += 1
+            y_ = regressor.forward_suffix(x_[active])
+            delta = y_ - mean[active]
+            mean[active] += delta / k
+            m2[active] += delta * (y_ - mean[active])
+            if k < max(min_samples, 2):
+                continue
+            # standard error of the mean and of the standard deviation (Gaussian)
+            var = m2[active] / (k - 1)
+            sem = torch.sqrt(var / k)
+            sesd = torch.sqrt(var / (2 * (k - 1)))
+            converged = ((sem <= tolerance) & (sesd <= tolerance)).all(dim=1)
+            count[active[converged]] = k
+            active = active[~converged]
+        return mean, torch.sqrt(m2 / count.unsqueeze(1)), count
 
     def __enter__(self):
         self.start = timeit.default_timer()
@@ -59,3 +395,141 @@ class PredictiveEngine:
             + str(self.took)
             + " ms"
         )
+
+
+# Network loaded by each worker process of a PredictionPool (one per process), and
+# its compiled sampling functions (only with torch_compile)
+_worker_regressor = None
+_worker_compiled = []
+
+
+def _init_worker(
+    network_filename, n_latents, output_layer_type, num_threads, backend, torch_compile
+):
+    global _worker_regressor
+    # Limit the intra-op threads so that the workers do not oversubscribe the cores
+    torch.set_num_threads(num_threads)
+    if backend == "script":
+        _worker_regressor, _ = PredictiveEngine.loadScripted(
+            network_filename, n_latents, torch.device("cpu")
+        )
+    else:
+        _worker_regressor, _ = PredictiveEngine.loadNetwork(
+            network_filename, n_latents, output_layer_type, torch.device("cpu")
+        )
+        if torch_compile:
+            _worker_compiled.extend(PredictiveEngine.compileSampling(_worker_regressor))
+
+
+def _predict_shard(X, num_samples, block_size, options):
+    """Predicts a shard in a worker process. Returns the prediction, the process id
+    and the call times of the compiled functions (see PredictionPool.report)"""
+    prediction = PredictiveEngine.predict(
+        _worker_regressor,
+        X,
+        num_samples,
+        block_size=block_size,
+        progress=False,
+        **options,
+    )
+    call_times = {
+        function.name: list(function.call_times)
+        for function in _worker_compiled
+        if function.compiled is not None
+    }
+    return prediction, os.getpid(), call_times
+
+
+class PredictionPool:
+    """
+    Pool of CPU worker processes for sharded prediction. Each worker loads the trained
+    network once, and the rows passed to predict() are split into shards that are
+    evaluated concurrently. Results are returned in the original row order.
+    """
+
+    def __init__(
+        self,
+        network_filename,
+        n_latents,
+        output_layer_type,
+        workers,
+        threads_per_worker=0,
+        backend="torch",
+        torch_compile=False,
+    ):
+        self.workers = workers
+        # call times of the compiled functions of each worker (by process id)
+        self.call_times = {}
+        if threads_per_worker <= 0:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        Console.info(
+            "Starting",
+            workers,
+            "prediction workers with",
+            threads_per_worker,
+            "threads each",
+        )
+        # spawn (rather than fork) as the parent process has already initialised torch
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                network_filename,
+                n_latents,
+                output_layer_type,
+                threads_per_worker,
+                backend,
+                torch_compile,
+            ),
+        )
+
+    def predict(self, X, num_samples, block_size=4096, **options):
+        """Same as PredictiveEngine.predict, with the rows of X sharded across the
+        worker processes. Extra options (e.g. uncertainty_mode) are passed to
+        PredictiveEngine.predict"""
+        n_rows = X.shape[0]
+        if n_rows == 0:
+            prediction, pid, call_times = self.executor.submit(
+                _predict_shard, X, num_samples, block_size, options
+            ).result()
+            self.call_times[pid] = call_times
+            return prediction
+        # Several shards per worker to balance the load, but never larger than a block
+        shard_size = max(1, min(block_size, math.ceil(n_rows / (4 * self.workers))))
+        shards = [X[i : i + shard_size] for i in range(0, n_rows, shard_size)]
+        p_mean = []
+        p_stdv = []
+        p_count = []
+        done = 0
+        # map() yields the results in submission (row) order
+        for (mean, stdv, count), pid, call_times in self.executor.map(
+            _predict_shard,
+            shards,
+            [num_samples] * len(shards),
+            [block_size] * len(shards),
+            [options] * len(shards),
+        ):
+            self.call_times[pid] = call_times  # cumulative, the last one is kept
+            p_mean.append(mean)
+            p_stdv.append(stdv)
+            p_count.append(count)
+            done += len(mean)
+            Console.progress(done, n_rows)
+        return np.concatenate(p_mean), np.concatenate(p_stdv), np.concatenate(p_count)
+
+    def report(self):
+        """Logs the compilation and steady-state times of the compiled functions of
+        each worker (see utilities.CompiledFunction.report)"""
+        for worker, pid in enumerate(sorted(self.call_times)):
+            for name, call_times in self.call_times[pid].items():
+                report_call_times(name + " (worker " + str(worker) + ")", call_times)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import inspect
+import json
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Output layer types, stored as an integer in the scripted module
+OUTPUT_TYPES = ["linear", "softmax", "softmin"]
+
+
+class PosteriorPredictor(nn.Module):
+    """Self-contained (plain PyTorch) version of the BayesianRegressor posterior
+    predictor, that can be scripted (TorchScript) or exported to ONNX. The Bayesian
+    layer is stored as its posterior mean and standard deviation, and the weight
+    noise is an input of the graph, so no blitz code is needed to run it"""
+
+    def __init__(self, regressor, output_type="linear"):
+        super().__init__()
+        self.linear_input = regressor.linear_input
+        self.linear2 = regressor.linear2
+        self.linear3 = regressor.linear3
+        self.linear_output = regressor.linear_output
+
+        # same parametrisation as blitz: w = mu + log(1 + exp(rho)) * eps
+        blinear = regressor.blinear1
+        self.register_buffer("weight_mu", blinear.weight_mu.detach().clone())
+        self.register_buffer("bias_mu", blinear.bias_mu.detach().clone())
+        weight_sigma = F.softplus(blinear.weight_rho.detach())
+        bias_sigma = F.softplus(blinear.bias_rho.detach())
+        if blinear.freeze:
+            weight_sigma.zero_()
+            bias_sigma.zero_()
+        self.register_buffer("weight_sigma", weight_sigma)
+        self.register_buffer("bias_sigma", bias_sigma)
+        self.output_type = OUTPUT_TYPES.index(output_type)
+
+    def forward(self, x, eps_w, eps_b):
+        """Posterior predictions of the input block x for K weight noise samples
+        Parameters:
+            x: torch.tensor -> input block, shape (N, input_dim)
+            eps_w: torch.tensor -> standard normal noise, shape (K, DIM1, DIM1)
+            eps_b: torch.tensor -> standard normal noise, shape (K, DIM1)
+        Returns torch.tensor of shape (K, N, output_dim)
+        """
+        x_ = self.forward_prefix(x)
+        weight = self.weight_mu + self.weight_sigma * eps_w
+        bias = self.bias_mu + self.bias_sigma * eps_b
+        x_ = torch.einsum("ni,koi->kno", x_, weight) + bias.unsqueeze(1)
+        sample_nbr, n_rows = x_.shape[0], x_.shape[1]
+        # The tail is evaluated on the flattened (K x N) rows, as the output layer
+        # (softmax/softmin) normalises along the second dimension
+        y_ = self.forward_tail(x_.reshape(sample_nbr * n_rows, -1))
+        return y_.reshape(sample_nbr, n_rows, -1)
+
+    @torch.jit.export
+    def forward_prefix(self, x):
+        """Deterministic input stage of the network (linear_input)"""
+        return self.linear_input(x)
+
+    @torch.jit.export
+    def forward_suffix(self, x_):
+        """Stochastic stage of the network. Each call draws a new set of weights"""
+        weight = self.weight_mu + self.weight_sigma * torch.randn_like(self.weight_mu)
+        bias = self.bias_mu + self.bias_sigma * torch.randn_like(self.bias_mu)
+        return self.forward_tail(F.linear(x_, weight, bias))
+
+    def forward_tail(self, x_):
+        """Deterministic stage of the network that follows the Bayesian layer"""
+        x_ = F.silu(x_)
+        x_ = F.silu(self.linear2(x_))
+        x_ = self.linear_output(self.linear3(x_))
+        if self.output_type == 1:
+            x_ = F.softmax(x_, dim=1)
+        elif self.output_type == 2:
+            x_ = F.softmin(x_, dim=1)
+        return x_
+
+    @torch.jit.export
+    def sample(self, x, sample_nbr: int):
+        """Draws sample_nbr posterior predictions for the input block x, with the same
+        semantics as BayesianRegressor.sample
+        Returns torch.tensor of shape (sample_nbr, N, output_dim)
+        """
+        out_dim, in_dim = self.weight_mu.shape[0], self.weight_mu.shape[1]
+        eps_w = torch.randn([sample_nbr, out_dim, in_dim], device=x.device)
+        eps_b = torch.randn([sample_nbr, out_dim], device=x.device)
+        return self.forward(x, eps_w, eps_b)
+
+
+def export_scripted(predictor, filename, metadata):
+    """Scripts the predictor and stores it, together with its metadata (JSON), in a
+    TorchScript file that can be loaded with torch.jit.load"""
+    scripted = torch.jit.script(predictor)
+    torch.jit.save(
+        scripted, filename, _extra_files={"metadata.json": json.dumps(metadata)}
+    )
+
+
+def export_onnx(predictor, filename, metadata):
+    """Exports the predictor graph (with the weight noise as inputs) to ONNX. The
+    number of rows and of samples are dynamic axes. Requires the onnx package"""
+    input_dim = predictor.linear_input.in_features
+    x = torch.zeros((2, input_dim))
+    eps_w = torch.zeros((3,) + tuple(predictor.weight_mu.shape))
+    eps_b = torch.zeros((3,) + tuple(predictor.bias_mu.shape))
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # The TorchScript based exporter (the only one before torch 2.5) handles the
+        # dynamic axes, so it is kept where the dynamo exporter is the default
+        options["dynamo"] = False
+    torch.onnx.export(
+        predictor,
+        (x, eps_w, eps_b),
+        filename,
+        input_names=["x", "eps_w", "eps_b"],
+        output_names=["samples"],
+        dynamic_axes={
+            "x": {0: "rows"},
+            "eps_w": {0: "samples"},
+            "eps_b": {0: "samples"},
+            "samples": {0: "samples", 1: "rows"},
+        },
+        **options,
+    )
+    with open(filename + ".json", "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def load_scripted(filename, device):
+    """Loads a TorchScript predictor exported by export_scripted
+
+    Returns the scripted module (in eval mode) and its metadata dictionary"""
+    extra_files = {"metadata.json": ""}
+    predictor = torch.jit.load(filename, map_location=device, _extra_files=extra_files)
+    predictor.eval()
+    return predictor, json.loads(extra_files["metadata.json"])
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import os
+import re
+
+import pandas as pd
+
+from bnn_inference.tools.console import Console
+
+# Table formats, picked by file extension. Anything else is read/written as CSV
+PARQUET_EXTENSIONS = [".parquet", ".pq"]
+ARROW_EXTENSIONS = [".arrow", ".feather", ".ipc"]
+
+
+def table_format(filename):
+    """Returns the table format of filename: 'parquet', 'arrow' or 'csv'"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in PARQUET_EXTENSIONS:
+        return "parquet"
+    if extension in ARROW_EXTENSIONS:
+        return "arrow"
+    return "csv"
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _import_pyarrow():
+    # pyarrow is an optional dependency, only needed for Parquet/Arrow files
+    if not _has_pyarrow():
+        Console.quit(
+            "Parquet/Arrow files require the pyarrow package: pip install pyarrow"
+        )
+
+
+def table_columns(filename):
+    """Returns the column names of a table, reading only its header (or schema)"""
+    file_format = table_format(filename)
+    if file_format == "csv":
+        return list(pd.read_csv(filename, nrows=0).columns)
+    return list(_table_schema(filename).names)
+
+
+def filter_columns(names, regex):
+    """Returns the column names matching regex, as DataFrame.filter(regex=...)"""
+    return [name for name in names if re.search(regex, name)]
+
+
+def _table_schema(filename):
+    """Returns the Arrow schema of a Parquet or Arrow IPC table"""
+    _import_pyarrow()
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if table_format(filename) == "parquet":
+        return pq.read_schema(filename)
+    with pa.memory_map(filename) as source:
+        return pa.ipc.open_file(source).schema
+
+
+def _index_columns(schema):
+    """Returns the columns of a schema that store the pandas index"""
+    metadata = schema.pandas_metadata or {}
+    return [c for c in metadata.get("index_columns", []) if isinstance(c, str)]
+
+
+def _select_columns(filename, columns, index_col):
+    """Resolves columns (list of names or predicate on the name) to the list of
+    columns of the table that have to be read, always including the index column"""
+    if columns is None:
+        return None
+    names = table_columns(filename)
+    if callable(columns):
+        selected = [name for name in names if columns(name)]
+    else:
+        selected = [name for name in names if name in columns]
+    if table_format(filename) != "csv":
+        # the index stored by pandas is kept, as when reading the whole table
+        index_columns = _index_columns(_table_schema(filename))
+        selected = [c for c in index_columns if c not in selected] + selected
+    elif index_col is not None and names[index_col] not in selected:
+        selected.insert(0, names[index_col])
+    return selected
+
+
+def read_table(filename, columns=None, index_col=None, dtype=None):
+    """Reads a CSV, Parquet or Arrow IPC (Feather) table, picked by file extension
+
+    Parameters
+    ----------
+    filename : str
+        Input table
+    columns : list or callable
+        Columns to read, as a list of names or a predicate on the column name, by
+        default None (all the columns)
+    index_col : int
+        Column used as index (CSV only, Parquet/Arrow tables keep the index stored by
+        pandas), by default None
+    dtype : dict
+        Data type of some of the columns (e.g. np.float32 for the latent vectors), by
+        default None (inferred)
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    usecols = _select_columns(filename, columns, index_col)
+    file_format = table_format(filename)
+    if file_format == "csv":
+        return _read_csv(filename, index_col, usecols, dtype)
+    _import_pyarrow()
+    import pyarrow.parquet as pq
+    from pyarrow import feather
+
+    if file_format == "parquet":
+        table = pq.read_table(filename, columns=usecols)
+    else:
+        # Arrow IPC files are memory-mapped
+        table = feather.read_table(filename, columns=usecols, memory_map=True)
+    return _cast(table.to_pandas(), dtype)
+
+
+def _read_csv(filename, index_col, usecols, dtype):
+    """Reads a CSV file with the multi-threaded pyarrow parser when available and all
+    the selected columns have a numeric dtype. Otherwise the default parser is used,
+    as in iter_table: the pyarrow type inference differs (e.g. it parses ISO dates as
+    timestamps), and the untyped columns are copied as they are to the predictions.
+    The pyarrow parser names the unnamed columns '' instead of 'Unnamed: <i>', so
+    they are renamed as the default parser would do"""
+    header = table_columns(filename)
+    unnamed = [name for name in header if name.startswith("Unnamed: ")]
+    numeric = (
+        usecols is not None
+        and dtype is not None
+        and all(
+            name in dtype and pd.api.types.is_numeric_dtype(dtype[name])
+            for name in usecols
+        )
+    )
+    if not numeric or not _has_pyarrow() or len(unnamed) > 1:
+        return pd.read_csv(filename, index_col=index_col, usecols=usecols, dtype=dtype)
+    if usecols is not None:
+        usecols = ["" if name in unnamed else name for name in usecols]
+    df = pd.read_csv(
+        filename, index_col=index_col, usecols=usecols, dtype=dtype, engine="pyarrow"
+    )
+    if unnamed:
+        df = df.rename(columns={"": unnamed[0]})
+    if df.index.name == "":
+        df.index.name = None
+    return df
+
+
+def _cast(df, dtype):
+    # Parquet/Arrow columns are already typed, only those with a different type
+    # than requested are converted
+    if dtype is None:
+        return df
+    return df.astype({c: t for c, t in dtype.items() if c in df.columns})
+
+
+def iter_table(filename, chunk_size, columns=None, index_col=None, dtype=None):
+    """Streaming version of read_table: yields the table in dataframes of chunk_size
+    rows, so that the memory footprint is bounded by the chunk size"""
+    usecols = _select_columns(filename, columns, index_col)
+    file_format = table_format(filename)
+    if file_format == "csv":
+        yield from pd.read_csv(
+            filename,
+            index_col=index_col,
+            usecols=usecols,
+            dtype=dtype,
+            chunksize=chunk_size,
+        )
+        return
+    _import_pyarrow()
+    import pyarrow.parquet as pq
+    from pyarrow import feather
+
+    if file_format == "parquet":
+        parquet_file = pq.ParquetFile(filename)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=usecols):
+            # record batches do not restore the stored index by themselves
+            df = _restore_index(batch.to_pandas(), parquet_file.schema_arrow)
+            yield _cast(df, dtype)
+    else:
+        # Arrow IPC files are memory-mapped, slicing them does not copy the data
+        table = feather.read_table(filename, columns=usecols, memory_map=True)
+        for start in range(0, table.num_rows, chunk_size):
+            yield _cast(table.slice(start, chunk_size).to_pandas(), dtype)
+
+
+def _restore_index(df, schema):
+    index_columns = [c for c in _index_columns(schema) if c in df.columns]
+    if index_columns:
+        df = df.set_index(index_columns)
+        df.index.names = [
+            None if name.startswith("__index_level_") else name
+            for name in df.index.names
+        ]
+    return df
+
+
+class TableWriter:
+    """
+    Writes a dataframe, or a sequence of dataframes with the same columns (e.g. the
+    chunks of a streaming prediction), as a CSV, Parquet or Arrow IPC table picked by
+    file extension. Parquet and Arrow tables are typed and compressed (zstd).
+    """
+
+    def __init__(self, filename, index=True):
+        self.filename = filename
+        self.index = index
+        self.file_format = table_format(filename)
+        self.writer = None
+        self.schema = None
+        self.n_chunks = 0
+        if self.file_format != "csv":
+            _import_pyarrow()
+
+    def write(self, df):
+        if self.file_format == "csv":
+            if self.n_chunks == 0:
+                df.to_csv(self.filename, index=self.index)
+            else:
+                # Append the chunk to the already exported rows
+                df.to_csv(self.filename, mode="a", header=False, index=self.index)
+        else:
+            import pyarrow as pa
+            import pyarrow.ipc as ipc
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=self.index)
+            if self.writer is None:
+                self.schema = table.schema
+                if self.file_format == "parquet":
+                    self.writer = pq.ParquetWriter(
+                        self.filename, table.schema, compression="zstd"
+                    )
+                else:
+                    self.writer = ipc.new_file(
+                        self.filename,
+                        table.schema,
+                        options=ipc.IpcWriteOptions(compression="zstd"),
+                    )
+            else:
+                # all the chunks share the schema of the first one
+                table = table.cast(self.schema)
+            self.writer.write_table(table)
+        self.n_chunks += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_table(df, filename, index=True):
+    """Writes df as a CSV, Parquet or Arrow IPC table, picked by file extension"""
+    with TableWriter(filename, index=index) as writer:
+        writer.write(df)
@@ -1,6 +1,110 @@
+import statistics
+import time
+
 import numpy as np
 import torch
 
+from bnn_inference.tools.console import Console
+
+
+def get_torch_device(gpu_index, cpu_only=False):
+    if torch.cuda.is_available() and not cpu_only:
+        if torch.cuda.device_count() > 1:
+            if gpu_index is None or gpu_index == 0:
+                device = torch.device("cuda:0")
+                torch.cuda.set_device("cuda:0")
+            else:
+                device = torch.device("cuda:1")
+                torch.cuda.set_device("cuda:1")
+        else:
+            device = torch.device("cuda:0")
+        Console.info("CUDA detected, using device: ", device)
+    else:
+        Console.info("Using CPU")
+        device = torch.device("cpu")
+    return device
+
+
+# Precisions of the forward pass: float32, or bfloat16 autocast (see autocast)
+PRECISIONS = ["float32", "bfloat16"]
+
+
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        Console.error("Unknown precision:", precision)
+        Console.error("Currently valid options are: " + ", ".join(PRECISIONS))
+        Console.quit("Leaving...")
+
+
+def autocast(device, precision):
+    """Context manager running the forward pass in the requested precision. With
+    'bfloat16', the matrix products (linear layers) run in bfloat16, while the
+    parameters, the weight sampling (reparameterisation) and the KL divergence, which
+    are elementwise operations, stay in float32"""
+    return torch.autocast(
+        device_type=device.type,
+        dtype=torch.bfloat16,
+        enabled=precision == "bfloat16",
+    )
+
+
+class CompiledFunction:
+    """
+    Compiled (torch.compile) version of a function, e.g. a bound method of the network.
+    Compilation happens on the first call, and on any later call with new input shapes
+    or settings. If torch.compile is unavailable or fails (unsupported platform, missing
+    compiler), the function runs in eager mode instead. The wall time of the first call
+    (compilation) and of the following calls (steady state) are kept for report().
+    """
+
+    def __init__(self, function, name):
+        self.function = function
+        self.name = name
+        self.compiled = None
+        self.call_times = []
+        try:
+            self.compiled = torch.compile(function)
+        except Exception as ex:
+            Console.warn("torch.compile unavailable for", name, "(" + str(ex) + ")")
+            Console.warn("Running", name, "in eager mode")
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            result = self.compiled(*args, **kwargs)
+        except Exception as ex:
+            if self.call_times:
+                raise  # already compiled, not a compilation error
+            Console.warn("Compilation of", self.name, "failed (" + str(ex) + ")")
+            Console.warn("Running", self.name, "in eager mode")
+            self.compiled = None
+            return self.function(*args, **kwargs)
+        self.call_times.append(time.perf_counter() - start)
+        return result
+
+    def report(self):
+        """Logs the compilation time (first call) and the steady-state time per call
+        (median of the following calls, robust to occasional recompilations)"""
+        if self.compiled is None:
+            return
+        report_call_times(self.name, self.call_times)
+
+
+def report_call_times(name, call_times):
+    """Logs the call times of a compiled function (see CompiledFunction.report), also
+    used for those measured in worker processes"""
+    if not call_times:
+        return
+    message = "{:.2f} s".format(call_times[0])
+    if len(call_times) > 1:
+        steady_time = statistics.median(call_times[1:])
+        message += " | steady state: {:.3f} ms per call ({} calls)".format(
+            1000 * steady_time, len(call_times) - 1
+        )
+    Console.info("Compiled", name, "| first call (compilation):", message)
+
 
 def calc_auxiliary_target_distribution(mat_soft_assignment):
     # auxiliary target distribution. n_samples * n_classes
@@ -7,11 +7,15 @@ See LICENSE file in the project root for full license information.
 """
 # Author: Jose Cappelletto (j.cappelletto@soton.ac.uk)
 
+import copy
+import math
 import os
+import signal
 import statistics
 
 # Import general libraries
 import sys
+import time
 
 import numpy as np
 import pandas as pd
@@ -21,11 +25,25 @@ import torch.optim as optim
 # Import sklearn dataset parsers and samples
 from sklearn.model_selection import train_test_split
 
-from bnn_inference.tools.bnn_model import BayesianRegressor
+from bnn_inference.tools.bnn_model import BayesianRegressor, evaluate_posterior
+from bnn_inference.tools.checkpoint import (
+    load_checkpoint,
+    rng_state,
+    save_checkpoint,
+    set_rng_state,
+)
 
 # Toolkit specific imports
 from bnn_inference.tools.console import Console
 from bnn_inference.tools.dataloader import CustomDataloader
+from bnn_inference.tools.dataset_cache import DatasetCache
+from bnn_inference.tools.table_io import write_table
+from bnn_inference.tools.utilities import (
+    CompiledFunction,
+    autocast,
+    check_precision,
+    get_torch_device,
+)
 
 ################################################################
 # TODO: Automate invocation of this script from the command line
@@ -38,6 +56,19 @@ from bnn_inference.tools.dataloader import CustomDataloader
 # export EXP="elbo10_ce100
 ################################################################
 
+# Batch size of the original training setup, reference of the learning rate scaling
+REFERENCE_BATCH_SIZE = 8
+
+# Columns of the training log (loss history)
+LOG_COLUMNS = [
+    "train_loss",
+    "train_fit_loss",
+    "train_kld_loss",
+    "valid_loss",
+    "valid_fit_loss",
+    "valid_kld_loss",
+]
+
 
 def set_filenames(output, logfile, network, n_latents, num_epochs, n_samples):
     # for each output file, we check if user defined name is provided. If not, use default naming convention
@@ -87,22 +118,108 @@ def set_filenames(output, logfile, network, n_latents, num_epochs, n_samples):
     return predictions_filename, log_filename, network_filename
 
 
-def get_torch_device(gpu_index, cpu_only=False):
-    if torch.cuda.is_available() and not cpu_only:
-        if torch.cuda.device_count() > 1:
-            if gpu_index is None or gpu_index == 0:
-                device = torch.device("cuda:0")
-                torch.cuda.set_device("cuda:0")
-            else:
-                device = torch.device("cuda:1")
-                torch.cuda.set_device("cuda:1")
+def iterate_batches(X, y, batch_size, shuffle=True):
+    """Yields the (X, y) mini-batches of tensors already on the device. Shuffling
+    permutes the row indices on the same device, so no data is copied to/from the
+    host (unlike DataLoader collation)"""
+    n_rows = X.shape[0]
+    if shuffle:
+        order = torch.randperm(n_rows, device=X.device)
+    for start in range(0, n_rows, batch_size):
+        if shuffle:
+            rows = order[start : start + batch_size]
+            yield X[rows], y[rows]
         else:
-            device = torch.device("cuda:0")
-        Console.info("CUDA detected, using device: ", device)
-    else:
-        Console.info("Using CPU")
-        device = torch.device("cpu")
-    return device
+            yield X[start : start + batch_size], y[start : start + batch_size]
+
+
+def loss_terms(loss, fit_loss, kld_loss, device):
+    """Stacks the loss terms of a batch (detached) into a tensor on the device. When
+    the network is frozen, the complexity cost may be a scalar instead of a tensor"""
+    return torch.stack(
+        [
+            torch.as_tensor(term, device=device).detach().float()
+            for term in (loss, fit_loss, kld_loss)
+        ]
+    )
+
+
+def prediction_table(y, evaluation, target_names):
+    """Returns the table of targets, predicted means and uncertainties (std) of a
+    dataset split: target_<name>, pred_<name> and uncertainty_<name> columns"""
+    columns = {}
+    for prefix, values in (
+        ("target_", y),
+        ("pred_", evaluation["mean"]),
+        ("uncertainty_", evaluation["std"]),
+    ):
+        for i, name in enumerate(target_names):
+            columns[prefix + name] = values[:, i]
+    return pd.DataFrame(columns)
+
+
+def print_evaluation(name, evaluation, target_names):
+    """Logs the RMSE, NLL and 95% interval coverage of each target of a split"""
+    for i, target in enumerate(target_names):
+        Console.info(
+            "[" + name + " dataset]",
+            target,
+            "RMSE: {:.4f} | NLL: {:.4f} | Coverage (95%): {:.3f}".format(
+                evaluation["rmse"][i], evaluation["nll"][i], evaluation["coverage"][i]
+            ),
+        )
+
+
+def report_step_times(step_times, torch_compile):
+    """Logs the wall time per training step (forward passes, backward pass and
+    optimizer update) of the first epoch, which includes the compilation with
+    --compile, and the steady state (median of the following epochs). An eager run
+    logs the reference to compare with"""
+    if not step_times:
+        return
+    message = "first epoch: {:.3f} ms per step".format(1000 * step_times[0])
+    if len(step_times) > 1:
+        message += " | steady state: {:.3f} ms per step ({} epochs)".format(
+            1000 * statistics.median(step_times[1:]), len(step_times) - 1
+        )
+    mode = "compiled" if torch_compile else "eager"
+    Console.info("Training step (" + mode + ") |", message)
+
+
+def write_loss_log(log_filename, history):
+    """Writes the loss history (one list per LOG_COLUMNS entry) as the training log"""
+    export_df = pd.DataFrame(history).transpose()
+    export_df.columns = LOG_COLUMNS
+    export_df.index.names = ["index"]
+    write_table(export_df, log_filename, index=False)
+
+
+def load_training_dataset(
+    latent_csv, latent_key, target_csv, target_key, uuid_key, dataset_cache=""
+):
+    """Loads and joins the input (latent) and target files. Returns the (X, y, uuid)
+    dataframes of the matched pairs, from the dataset cache if provided"""
+    Console.info("Loading dataset: " + latent_csv)
+    cache, dataset = None, None
+    if dataset_cache:
+        # The joined dataset is reused while the input files and keys do not change
+        cache = DatasetCache(
+            dataset_cache,
+            [latent_csv, target_csv],
+            {"latent_key": latent_key, "target_key": target_key, "uuid_key": uuid_key},
+        )
+        dataset = cache.load()
+    if dataset is None:
+        dataset = CustomDataloader.load_dataset(
+            input_filename=latent_csv,  # dataset containing the input. e.g. the latent vector
+            target_filename=target_csv,  # target dataset containing the key to be predicted, e.g. mean_slope
+            matching_key=uuid_key,
+            target_key_prefix=target_key,
+            input_key_prefix=latent_key,
+        )  # relative_path is the common key in both tables
+        if cache is not None:
+            cache.store(*dataset)
+    return dataset
 
 
 def train_impl(
@@ -113,36 +230,55 @@ def train_impl(
     uuid_key,
     output_csv,
     output_network_filename,
-    output_layer_type,
-    log_filename,
-    num_epochs,
-    num_samples,
-    xratio,
-    scale_factor,
-    learning_rate,
-    lambda_loss,
-    lambda_elbo,
-    loss_method,
-    gpu_index,
-    cpu_only,
+    output_layer_type="linear",
+    log_filename=None,
+    num_epochs=100,
+    num_samples=10,
+    xratio=0.9,
+    scale_factor=1.0,
+    learning_rate=1e-3,
+    lambda_loss=1.0,
+    lambda_elbo=1.0,
+    loss_method="mse",
+    gpu_index=0,
+    cpu_only=False,
+    dataset_cache="",
+    kl_method="mc",
+    bayesian_layer="blitz",
+    batch_size=REFERENCE_BATCH_SIZE,
+    lr_scaling="none",
+    valid_every=1,
+    valid_samples=0,
+    patience=0,
+    min_delta=0.0,
+    checkpoint_every=0,
+    resume=False,
+    precision="float32",
+    torch_compile=False,
+    dataset=None,
 ):
     Console.info(
         "Bayesian NN training module: learning hi-res terrain observations from feature representation of low resolution priors"
     )
+    # Checkpoints are stored next to the trained network, so it must be named
+    if (checkpoint_every > 0 or resume) and not output_network_filename:
+        Console.error(
+            "Checkpoints (--checkpoint-every, --resume) require an output network "
+            "filename (--output-network-filename)"
+        )
+        Console.quit("Leaving...")
 
-    Console.info("Loading dataset: " + latent_csv)
-    X_df, y_df, index_df = CustomDataloader.load_dataset(
-        input_filename=latent_csv,  # dataset containing the input. e.g. the latent vector
-        target_filename=target_csv,  # target dataset containing the key to be predicted, e.g. mean_slope
-        matching_key=uuid_key,
-        target_key_prefix=target_key,
-        input_key_prefix=latent_key,
-    )  # relative_path is the common key in both tables
+    if dataset is None:
+        dataset = load_training_dataset(
+            latent_csv, latent_key, target_csv, target_key, uuid_key, dataset_cache
+        )
+    X_df, y_df, index_df = dataset
 
     X = X_df.to_numpy(
-        dtype=np.float64
+        dtype=np.float32
     )  # Explicit numeric data conversion to avoid silent bugs with implicit string conversion
-    y = y_df.to_numpy(dtype=np.float64)  # Apply to both target and latent data
+    # Apply to both target and latent data (float32, as used by the network)
+    y = y_df.to_numpy(dtype=np.float32)
     # We need to peek the number of latent variables to configure the network and set up the filenames
     n_latents = X.shape[
         1
@@ -226,9 +362,26 @@ def train_impl(
         "{:.4}".format(np.amax(y_norm)),
     )
 
-    X_train, X_valid, y_train, y_valid = train_test_split(
-        X_norm, y_norm, train_size=xratio, shuffle=True  # 8:2 ratio
-    )
+    # Checkpoints are stored next to the trained network
+    checkpoint_filename = output_network_filename + ".ckpt"
+    checkpoint = None
+    if resume:
+        checkpoint = load_checkpoint(checkpoint_filename)
+        if checkpoint is None:
+            Console.warn("No checkpoint found at [", checkpoint_filename, "]")
+            Console.warn("Training from scratch")
+        elif len(checkpoint["train_rows"]) + len(checkpoint["valid_rows"]) != n_pairs:
+            Console.quit("The checkpoint does not match the loaded dataset")
+
+    # The split is done on the row indices, so a resumed run uses the same split
+    if checkpoint is not None:
+        train_rows, valid_rows = checkpoint["train_rows"], checkpoint["valid_rows"]
+    else:
+        train_rows, valid_rows = train_test_split(
+            np.arange(n_pairs), train_size=xratio, shuffle=True  # 8:2 ratio
+        )
+    X_train, X_valid = X_norm[train_rows], X_norm[valid_rows]
+    y_train, y_valid = y_norm[train_rows], y_norm[valid_rows]
     # Convert train and test vectors to tensors
     X_train, y_train = torch.Tensor(X_train).float(), torch.Tensor(y_train).float()
     X_valid, y_valid = torch.Tensor(X_valid).float(), torch.Tensor(y_valid).float()
@@ -251,10 +404,28 @@ def train_impl(
         exit(1)
 
     # set the device
-    Console.warn("Using device:", torch.cuda.current_device())
+    Console.warn("Using device:", device)
+    if bayesian_layer not in ["blitz", "local"]:
+        Console.error("Unknown Bayesian layer: ", bayesian_layer)
+        Console.error("Currently valid options are: blitz, local")
+        Console.quit("Leaving...")
+    Console.info("Using Bayesian layer: ", bayesian_layer)
     regressor = BayesianRegressor(
-        input_dim=n_latents, output_dim=n_targets, output_type=output_layer_type
+        input_dim=n_latents,
+        output_dim=n_targets,
+        output_type=output_layer_type,
+        bayesian_layer=bayesian_layer,
     ).to(device)
+    # Optional learning rate scaling rule for batch sizes other than the reference one
+    if lr_scaling == "linear":
+        learning_rate = learning_rate * batch_size / REFERENCE_BATCH_SIZE
+    elif lr_scaling == "sqrt":
+        learning_rate = learning_rate * math.sqrt(batch_size / REFERENCE_BATCH_SIZE)
+    elif lr_scaling != "none":
+        Console.error("Unknown learning rate scaling rule:", lr_scaling)
+        Console.error("Currently valid options are: none, linear, sqrt")
+        Console.quit("Leaving...")
+    Console.info("Batch size:", batch_size, "| Learning rate:", learning_rate)
     optimizer = optim.Adam(regressor.parameters(), lr=learning_rate)  # learning rate
 
     if loss_method == "mse":
@@ -274,23 +445,44 @@ def train_impl(
         Console.error("Currently valid options are: mse, celoss")
         Console.quit("Leaving...")
 
+    if kl_method == "analytic":
+        # Closed-form KL divergence: no sampling noise, computed once per step
+        Console.info("Using analytic KL divergence")
+        try:
+            regressor.kl_divergence_analytic()
+        except ValueError as ex:
+            Console.quit(ex)
+    elif kl_method != "mc":
+        Console.error("Unknown KL divergence method:", kl_method)
+        Console.error("Currently valid options are: mc, analytic")
+        Console.quit("Leaving...")
+
+    check_precision(precision)
+    if precision != "float32":
+        Console.info("Using", precision, "autocast for the forward pass")
+
+    # The ELBO (forward passes and sample loop) is compiled with torch.compile, the
+    # backward pass and the optimizer step run as usual. The validation pass (no
+    # gradients) is a different graph, compiled separately
+    train_elbo = regressor_sample_elbow_weighed
+    valid_elbo = regressor_sample_elbow_weighed
+    if torch_compile:
+        Console.info("Compiling the training step (torch.compile)")
+        train_elbo = CompiledFunction(train_elbo, "training step")
+        valid_elbo = CompiledFunction(valid_elbo, "validation step")
+
     # print("Model's state_dict:")
     # for param.Tensor in regressor.state_dict():
     #     print(param.Tensor, "\t", regressor .state_dict()[param.Tensor].size())
     # NOTE: Beware of that training a Bayesian model does not operate in the same way as a
     # standard NN model. SGD may not result in an improved convergence rate when combined
     # with variational inference
-    data_batch_size = 8
+    data_batch_size = batch_size
 
-    ds_train = torch.utils.data.TensorDataset(X_train, y_train)
-    dataloader_train = torch.utils.data.DataLoader(
-        ds_train, batch_size=data_batch_size, shuffle=True
-    )
-
-    ds_valid = torch.utils.data.TensorDataset(X_valid, y_valid)
-    dataloader_valid = torch.utils.data.DataLoader(
-        ds_valid, batch_size=data_batch_size, shuffle=True
-    )
+    # The whole train/valid sets are kept on the device, and the mini-batches are
+    # sliced from them (see iterate_batches). labels: (N,1,1) -> (N,1)
+    X_train_dev, y_train_dev = X_train.to(device), y_train.squeeze(2).to(device)
+    X_valid_dev, y_valid_dev = X_valid.to(device), y_valid.squeeze(2).to(device)
 
     # Log of training and validation losses
     train_loss_history = []
@@ -299,6 +491,14 @@ def train_impl(
     valid_loss_history = []
     valid_fit_loss_history = []
     valid_kld_loss_history = []
+    history = [
+        train_loss_history,
+        train_fit_loss_history,
+        train_kld_loss_history,
+        valid_loss_history,
+        valid_fit_loss_history,
+        valid_kld_loss_history,
+    ]
 
     lambda_fit_loss = lambda_loss  # regularization parameter for the fit loss
     # (cost function is the sum of the scaled fit loss and the KL divergence loss)
@@ -319,72 +519,129 @@ def train_impl(
     # Add option to configure cosine or MSELoss
     # Improve constant torch.ones for CosineEmbeddingLoss, or juts use own cosine distance loss (torch compatible)
 
+    if valid_samples <= 0:
+        valid_samples = num_samples  # same number of samples as for training
+    valid_every = max(valid_every, 1)
+    # Early stopping state (only used when patience > 0)
+    best_valid_loss = math.inf
+    best_epoch = None
+    best_state = None
+    trained_epochs = 0
+
+    if checkpoint is not None:
+        # Continue from the last checkpoint: network, optimizer, losses and RNG state
+        regressor.load_state_dict(checkpoint["model_state_dict"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        for column, values in zip(history, checkpoint["history"]):
+            column.extend(values)
+        best_valid_loss = checkpoint["best_valid_loss"]
+        best_epoch = checkpoint["best_epoch"]
+        best_state = checkpoint["best_state"]
+        trained_epochs = checkpoint["epoch"]
+        set_rng_state(checkpoint["rng_state"])
+        Console.info("Resuming training at epoch [", trained_epochs, "]")
+
+    def capture_checkpoint():
+        # The state dicts refer to the live tensors (updated in place by the next
+        # epoch), so they are copied to keep the state at this epoch boundary
+        return {
+            "epoch": trained_epochs,
+            "model_state_dict": copy.deepcopy(regressor.state_dict()),
+            "optimizer": copy.deepcopy(optimizer.state_dict()),
+            "history": [list(column) for column in history],
+            "best_valid_loss": best_valid_loss,
+            "best_epoch": best_epoch,
+            "best_state": best_state,
+            "train_rows": train_rows,
+            "valid_rows": valid_rows,
+            "rng_state": rng_state(),
+        }
+
+    def write_checkpoint(checkpoint):
+        save_checkpoint(checkpoint, checkpoint_filename)
+        # the log is kept up to date too
+        write_loss_log(log_filename, checkpoint["history"])
+
+    # State at the last completed epoch, saved if the training is interrupted
+    last_checkpoint = None
+    step_times = []  # mean wall time per training step of each epoch
+    # Pre-emption (SIGTERM, e.g. from the job scheduler) stops as Ctrl-C does
+    sigterm_handler = signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
-        for epoch in range(num_epochs):
+        for epoch in range(trained_epochs, num_epochs):
             # if (epoch == 2):          # we train in non-Bayesian way during a first phase of P-epochs (P:50) as 'warm-up'
             #     regressor.unfreeze_()
             #     Console.info("Unfreezing the network")
 
-            # We store a list of losses for each epoch (multiple samples per epoch)
-            train_loss = []
-            valid_loss = []
-            # Loss (cost) values are separated into fit_loss and kld_loss
-            train_fit_loss = []
-            train_kld_loss = []
-            valid_fit_loss = []
-            valid_kld_loss = []
-
-            for i, (datapoints, labels) in enumerate(dataloader_train):
+            # The losses (total, fit_loss and kld_loss) are accumulated on the device
+            # and only synchronised once per epoch
+            train_losses = torch.zeros(3, device=device)
+            valid_losses = torch.zeros(3, device=device)
+            n_train_batches = 0
+            n_valid_batches = 0
+
+            epoch_start = time.perf_counter()
+            for datapoints, labels in iterate_batches(
+                X_train_dev, y_train_dev, batch_size, shuffle=True
+            ):
                 optimizer.zero_grad()
-                # labels.shape = (h,1,1) is adding an extra dimension to the tensor, so we need to remove it
-                labels = labels.squeeze(2)
-                _loss, _fit_loss, _kld_loss = regressor_sample_elbow_weighed(
-                    inputs=datapoints.to(device),
-                    labels=labels.to(device),
-                    criterion=criterion,  # MSELoss
-                    sample_nbr=num_samples,
-                    criterion_loss_weight=lambda_fit_loss,
-                    complexity_cost_weight=elbo_kld / X_train.shape[0],
-                )  # normalize the complexity cost by the number of input points
+                with autocast(device, precision):  # the backward pass runs outside
+                    _loss, _fit_loss, _kld_loss = train_elbo(
+                        inputs=datapoints,
+                        labels=labels,
+                        criterion=criterion,  # MSELoss
+                        sample_nbr=num_samples,
+                        criterion_loss_weight=lambda_fit_loss,
+                        complexity_cost_weight=elbo_kld / X_train.shape[0],
+                        kl_method=kl_method,
+                    )  # normalize the complexity cost by the number of input points
                 # the returned loss is the combination of fit loss (MSELoss) and
                 # complexity cost (KL_div against a nominal Normal distribution )
                 _loss.backward()
                 optimizer.step()
-                train_loss.append(_loss.item())  # keep track of training loss
-                train_fit_loss.append(_fit_loss.item())
-                # When the network is frozen the complexity cost is not computed and the kld_loss is 0
-                # The problem is that the return type changes from a Tensor to a scalar
-                if type(_kld_loss) is torch.Tensor:
-                    train_kld_loss.append(_kld_loss.item())
-                else:
-                    train_kld_loss.append(0.0)
-
-            for k, (valid_datapoints, valid_labels) in enumerate(dataloader_valid):
-                # calculate the fit loss and the KL-divergence cost for the test points set
-                valid_labels = valid_labels.squeeze(2)
-                _loss, _fit_loss, _kld_loss = regressor_sample_elbow_weighed(
-                    inputs=valid_datapoints.to(device),
-                    labels=valid_labels.to(device),
-                    criterion=criterion,
-                    sample_nbr=num_samples,
-                    criterion_loss_weight=lambda_fit_loss,  # regularization parameter to balance multiobjective cost function (fit loss vs KL div)
-                    complexity_cost_weight=elbo_kld / X_valid.shape[0],
-                )
-                valid_loss.append(_loss.item())  # keep track of training loss
-                valid_fit_loss.append(_fit_loss.item())
-                # When the network is frozen the complexity cost is not computed and the kld_loss is 0
-                # The problem is that the return type changes from a Tensor to a scalar
-                if type(_kld_loss) is torch.Tensor:
-                    valid_kld_loss.append(_kld_loss.item())
-                else:
-                    valid_kld_loss.append(0.0)
-
-            mean_train_loss = statistics.mean(train_loss)
-            mean_valid_loss = statistics.mean(valid_loss)
-            mean_train_fit_loss = statistics.mean(train_fit_loss)
-            mean_valid_fit_loss = statistics.mean(valid_fit_loss)
-            mean_train_kld_loss = statistics.mean(train_kld_loss)
-            mean_valid_kld_loss = statistics.mean(valid_kld_loss)
+                train_losses += loss_terms(_loss, _fit_loss, _kld_loss, device)
+                n_train_batches += 1
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)  # once per epoch, for the step time
+            step_times.append((time.perf_counter() - epoch_start) / n_train_batches)
+
+            # Validation every valid_every epochs (and after the last one)
+            validate = (epoch + 1) % valid_every == 0 or epoch == num_epochs - 1
+            if validate:
+                # The weights do not change during validation, so the closed-form KL
+                # divergence is computed once per epoch and shared by all the batches
+                valid_kl = None
+                if kl_method == "analytic":
+                    valid_kl = regressor.kl_divergence_analytic().detach()
+                for valid_datapoints, valid_labels in iterate_batches(
+                    X_valid_dev, y_valid_dev, batch_size, shuffle=False
+                ):
+                    # calculate the fit loss and the KL-divergence cost for the test points set
+                    # no gradients needed for validation
+                    with torch.no_grad(), autocast(device, precision):
+                        _loss, _fit_loss, _kld_loss = valid_elbo(
+                            inputs=valid_datapoints,
+                            labels=valid_labels,
+                            criterion=criterion,
+                            sample_nbr=valid_samples,
+                            # regularization parameter to balance multiobjective cost function (fit loss vs KL div)
+                            criterion_loss_weight=lambda_fit_loss,
+                            complexity_cost_weight=elbo_kld / X_valid.shape[0],
+                            kl_method=kl_method,
+                            kl_divergence=valid_kl,
+                        )
+                    valid_losses += loss_terms(_loss, _fit_loss, _kld_loss, device)
+                    n_valid_batches += 1
+
+            # Mean of the batch losses, single device synchronisation per epoch
+            train_losses = (train_losses / n_train_batches).tolist()
+            mean_train_loss, mean_train_fit_loss, mean_train_kld_loss = train_losses
+            if validate:
+                valid_losses = (valid_losses / max(n_valid_batches, 1)).tolist()
+            else:
+                valid_losses = [math.nan] * 3  # not validated in this epoch
+            mean_valid_loss, mean_valid_fit_loss, mean_valid_kld_loss = valid_losses
+            trained_epochs = epoch + 1
 
             # Log of training and validation losses
             train_loss_history.append(mean_train_loss)
@@ -395,30 +652,88 @@ def train_impl(
             valid_fit_loss_history.append(mean_valid_fit_loss)
             valid_kld_loss_history.append(mean_valid_kld_loss)
 
-            Console.info(
+            message = (
                 "Epoch ["
                 + str(epoch)
                 + "] Train (MSE + KLD): {:.3f}".format(mean_train_loss)
                 + " = {:.3f}".format(mean_train_fit_loss)
                 + " + {:.3f}".format(mean_train_kld_loss)
-                + "    | Valid (MSE + KLD): {:.3f}".format(mean_valid_loss)
-                + " = {:.3f}".format(mean_valid_fit_loss)
-                + " + {:.3f}".format(mean_valid_kld_loss)
             )
+            if validate:
+                message += (
+                    "    | Valid (MSE + KLD): {:.3f}".format(mean_valid_loss)
+                    + " = {:.3f}".format(mean_valid_fit_loss)
+                    + " + {:.3f}".format(mean_valid_kld_loss)
+                )
+            Console.info(message)
+
+            # Early stopping: keep a copy of the best network (validation loss) and
+            # stop after patience epochs without improvement
+            if validate and patience > 0:
+                if mean_valid_loss < best_valid_loss - min_delta:
+                    best_valid_loss = mean_valid_loss
+                    best_epoch = epoch
+                    best_state = {
+                        k: v.detach().clone() for k, v in regressor.state_dict().items()
+                    }
+                elif best_epoch is not None and epoch - best_epoch >= patience:
+                    Console.warn(
+                        "Early stopping: no improvement of the validation loss in the "
+                        "last",
+                        epoch - best_epoch,
+                        "epochs",
+                    )
+                    break
+            if checkpoint_every > 0:
+                last_checkpoint = capture_checkpoint()
+                if trained_epochs % checkpoint_every == 0:
+                    write_checkpoint(last_checkpoint)
             Console.progress(epoch, num_epochs)
 
     except KeyboardInterrupt:
         Console.warn("Training interrupted...")
+        if last_checkpoint is not None:
+            # The weights of the interrupted epoch are partial: the checkpoint holds
+            # the last completed epoch, and the interrupted one is repeated on resume
+            Console.warn(
+                "Saving checkpoint [",
+                checkpoint_filename,
+                "] of the last completed epoch [",
+                last_checkpoint["epoch"],
+                "]",
+            )
+            write_checkpoint(last_checkpoint)
         # sys.exit()
+    finally:
+        signal.signal(signal.SIGTERM, sigterm_handler)
+
+    report_step_times(step_times, torch_compile)
+    if torch_compile:
+        train_elbo.report()
+        valid_elbo.report()
+
+    if best_state is not None:
+        Console.info(
+            "Restoring the best network: epoch [",
+            best_epoch,
+            "], validation loss {:.3f}".format(best_valid_loss),
+        )
+        regressor.load_state_dict(best_state)
 
     Console.info("Training completed. Saving the model...")
     # create dictionary with the trained model and some training parameters
     model_dict = {
         "epochs": num_epochs,
+        "trained_epochs": trained_epochs,
+        "best_epoch": best_epoch,
         "batch_size": data_batch_size,
         "learning_rate": learning_rate,
+        "lr_scaling": lr_scaling,
         "lambda_fit_loss": lambda_fit_loss,
         "elbo_kld": elbo_kld,
+        "kl_method": kl_method,
+        "bayesian_layer": bayesian_layer,
+        "precision": precision,
         "optimizer": optimizer.state_dict(),
         "model_state_dict": regressor.state_dict(),
     }
@@ -426,183 +741,72 @@ def train_impl(
     print("Network name:", output_network_filename)
     torch.save(model_dict, output_network_filename)
 
-    export_df = pd.DataFrame(
-        [
-            train_loss_history,
-            train_fit_loss_history,
-            train_kld_loss_history,
-            valid_loss_history,
-            valid_fit_loss_history,
-            valid_kld_loss_history,
-        ]
-    ).transpose()
-    export_df.columns = [
-        "train_loss",
-        "train_fit_loss",
-        "train_kld_loss",
-        "valid_loss",
-        "valid_fit_loss",
-        "valid_kld_loss",
-    ]
-    export_df.index.names = ["index"]
-    export_df.to_csv(log_filename, index=False)
+    write_loss_log(log_filename, history)
 
-    idx = 0
-    # for x in X_valid:
     regressor.eval()  # we need to set eval mode before running inference
     # this will set dropout and batch normalization (if any) to evaluation mode
 
-    Console.info("Testing predictions [train dataset]...")
-    # Xp_ = torch.Tensor(X_norm).float()
-    Xt_ = torch.Tensor(X_train).float().to(device)
-    Xv_ = torch.Tensor(X_valid).float().to(device)
-
-    Xp_ = Xt_
-    y_list = (
-        y_train.squeeze().tolist()
-    )  # when converted to list, the shape is (N,) and will be stored in the same "cell" of the dataframe
-
-    uncertainty = []
-    predicted = []  # == y
-    for x in Xp_:
-        predictions = []
-        for n in range(num_samples):
-            # TODO: verify mismatch when training using batch_size > 1
-            # Add a dimension to the input data to match the input shape of the network
-            x_ = x.unsqueeze(0)
-            y_ = regressor(x_.to(device)).detach().cpu().numpy()
-            predictions.append(
-                y_
-            )  # N-dimensional output, stack/append as "single item"
-            # print (x_)
-            # print (y_)
-            # print (str(n), " ------------------------------")
-
-        p_mean = np.mean(predictions, axis=0)
-        p_stdv = np.std(predictions, axis=0)
-        predicted.append(p_mean)
-        uncertainty.append(p_stdv)
-
-        idx = idx + 1
-        Console.progress(idx, len(Xp_))
-
-    # predicted might contain a dimension with size 1, we need to squeeze it
-    predicted = np.squeeze(predicted)
-
-    # y_list, predicted and uncertainty lists need to be converted into sub-dataframes with as many columns as n_targets
-    column_names = []
-    for i in range(
-        n_targets
-    ):  # for each entry 'i' we create a column with the name 'y_i'
-        column_names.append("target_" + y_df.columns[i])
-
-    _ydf = pd.DataFrame(y_list, columns=column_names)
-
-    # we repeat this for predicted and uncertainty
-    column_names = []
-    for i in range(
-        n_targets
-    ):  # for each entry 'i' we create a column with the name 'y_i'
-        # the column names is created by prepending 'p_' to the column names of the y_df
-        column_names.append("pred_" + y_df.columns[i])
-        # column_names.append('predicted_' + str(i))
-    _pdf = pd.DataFrame(predicted, columns=column_names)
-
-    column_names = []
-    for i in range(
-        n_targets
-    ):  # for each entry 'i' we create a column with the name 'y_i'
-        column_names.append("uncertainty_" + y_df.columns[i])
-        # column_names.append('uncertainty_' + str(i))
-
-    # predicted might contain a dimension with size 1, we need to squeeze it
-    uncertainty = np.squeeze(uncertainty)
-
-    _udf = pd.DataFrame(uncertainty, columns=column_names)
-
-    # Append _ydf dataframe to pred_df
-    pred_df = _ydf
-    pred_df = pd.concat([pred_df, _pdf], axis=1)
-    # Check if --uncertainty flag is set
-    # if args.uncertainty:
-    pred_df = pd.concat([pred_df, _udf], axis=1)
-
-    Console.warn(
-        "Exported [train dataset] predictions to: ", "train_" + predictions_filename
-    )
-    pred_df.to_csv("train_" + predictions_filename, index=False)
-
-    ######################################################################################################################
-    # We repeat the same procedure for the validation dataset
-    ######################################################################################################################
-
-    Console.info("Testing predictions [validation dataset]...")
-    Xp_ = Xv_
-    y_list = (
-        y_valid.squeeze().tolist()
-    )  # when converted to list, the shape is (N,) and will be stored in the same "cell" of the dataframe
-
-    # Once trained, we start inferring
-    # expected = []
-    uncertainty = []
-    predicted = []  # == y
-    idx = 0
-    for x in Xp_:
-        predictions = []
-        for n in range(num_samples):
-            x_ = x.unsqueeze(0)
-            y_ = regressor(x_.to(device)).detach().cpu().numpy()
-            predictions.append(
-                y_
-            )  # N-dimensional output, stack/append as "single item"
-        p_mean = np.mean(predictions, axis=0)
-        p_stdv = np.std(predictions, axis=0)
-        predicted.append(p_mean)
-        uncertainty.append(p_stdv)
-
-        idx = idx + 1
-        Console.progress(idx, len(Xp_))
-
-    # y_list, predicted and uncertainty lists need to be converted into sub-dataframes with as many columns as n_targets
-    column_names = []
-    for i in range(
-        n_targets
-    ):  # for each entry 'i' we create a column with the name 'y_i'
-        column_names.append("target_" + y_df.columns[i])
-
-    _ydf = pd.DataFrame(y_list, columns=column_names)
-
-    # we repeat this for predicted and uncertainty
-    column_names = []
-    for i in range(
-        n_targets
-    ):  # for each entry 'i' we create a column with the name 'y_i'
-        # the column names is created by prepending 'p_' to the column names of the y_df
-        column_names.append("pred_" + y_df.columns[i])
-        # column_names.append('predicted_' + str(i))
-    # predicted might contain a dimension with size 1, we need to squeeze it
-    predicted = np.squeeze(predicted)
-    _pdf = pd.DataFrame(predicted, columns=column_names)
-
-    column_names = []
-    for i in range(
-        n_targets
-    ):  # for each entry 'i' we create a column with the name 'y_i'
-        column_names.append("uncertainty_" + y_df.columns[i])
-    # predicted might contain a dimension with size 1, we need to squeeze it
-    uncertainty = np.squeeze(uncertainty)
-    _udf = pd.DataFrame(uncertainty, columns=column_names)
-
-    # Finally, let's append _ydf dataframe to pred_df
-    # pred_df = pd.concat([pred_df, _ydf], axis=1)
-    pred_df = _ydf
-    pred_df = pd.concat([pred_df, _pdf], axis=1)
-    # Check if --uncertainty flag is set
-    # if args.uncertainty:
-    pred_df = pd.concat([pred_df, _udf], axis=1)
-
-    Console.warn(
-        "Exported [validation dataset] predictions to: ",
-        "valid_" + predictions_filename,
-    )
-    pred_df.to_csv("valid_" + predictions_filename, index=False)
+    target_names = list(y_df.columns)
+    split_evaluations = {}
+    for name, X_split, y_split in (
+        ("train", X_train_dev, y_train_dev),
+        ("validation", X_valid_dev, y_valid_dev),
+    ):
+        Console.info("Testing predictions [" + name + " dataset]...")
+        # All the rows of the split are evaluated in blocks, in a vectorised pass
+        evaluation = evaluate_posterior(
+            regressor, X_split, y_split, num_samples, precision=precision
+        )
+        print_evaluation(name, evaluation, target_names)
+        split_evaluations[name] = evaluation
+        pred_df = prediction_table(y_split.cpu().numpy(), evaluation, target_names)
+        # train_ / valid_ prefix on the file name, not on its directory
+        directory, basename = os.path.split(predictions_filename)
+        filename = os.path.join(directory, name[:5] + "_" + basename)
+        Console.warn("Exported [" + name + " dataset] predictions to: ", filename)
+        write_table(pred_df, filename, index=False)
+
+    if precision != "float32":
+        # Accuracy delta of the reduced precision against float32, evaluating the
+        # validation split with the same posterior samples (same random seed)
+        evaluations = []
+        for evaluation_precision in (precision, "float32"):
+            with torch.random.fork_rng():
+                torch.manual_seed(0)
+                evaluations.append(
+                    evaluate_posterior(
+                        regressor,
+                        X_valid_dev,
+                        y_valid_dev,
+                        num_samples,
+                        precision=evaluation_precision,
+                    )
+                )
+        reduced, reference = evaluations
+        for i, target in enumerate(target_names):
+            Console.info(
+                "[validation dataset]",
+                target,
+                precision,
+                "vs float32 | RMSE: {:.4f} vs {:.4f}".format(
+                    reduced["rmse"][i], reference["rmse"][i]
+                ),
+                "| max abs. difference of the mean: {:.2e}, std: {:.2e}".format(
+                    np.amax(np.abs(reduced["mean"][:, i] - reference["mean"][:, i])),
+                    np.amax(np.abs(reduced["std"][:, i] - reference["std"][:, i])),
+                ),
+            )
+
+    # Summary of the run, e.g. to rank the trials of a sweep (mean over the targets)
+    validated = [loss for loss in valid_loss_history if not math.isnan(loss)]
+    validated = validated or [math.nan]
+    valid_evaluation = split_evaluations["validation"]
+    return {
+        "trained_epochs": trained_epochs,
+        "best_epoch": best_epoch,
+        # loss of the saved network: the best one with early stopping, else the last
+        "valid_loss": best_valid_loss if best_state is not None else validated[-1],
+        "valid_rmse": float(np.mean(valid_evaluation["rmse"])),
+        "valid_nll": float(np.mean(valid_evaluation["nll"])),
+        "valid_coverage": float(np.mean(valid_evaluation["coverage"])),
+    }
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022, Ocean Perception Lab, Univ. of Southampton
+All rights reserved.
+Licensed under GNU General Public License v3.0
+See LICENSE file in the project root for full license information.
+"""
+
+import os
+import timeit
+
+import numpy as np
+import yaml
+
+from bnn_inference.tools.console import Console
+from bnn_inference.tools.predictor import PredictiveEngine
+from bnn_inference.tools.utilities import get_torch_device
+
+
+def uncertainty_report_impl(
+    latent_csv,
+    latent_key,
+    output_network_filename,
+    num_samples,
+    scale_factor,
+    block_size,
+    output_filename,
+    gpu_index,
+    cpu_only,
+):
+    Console.info(
+        "Uncertainty report: comparing moment propagation against Monte Carlo "
+        "posterior sampling"
+    )
+    if not os.path.exists(latent_csv):  # file or latent store (see convert)
+        Console.quit("Latent input file not found: ", latent_csv)
+    if not os.path.isfile(output_network_filename):
+        Console.quit("No pre-trained network found at: ", output_network_filename)
+    if output_filename == "":
+        output_filename = os.path.splitext(latent_csv)[0] + ".uncertainty_report.yaml"
+
+    np_latent, n_latents, _ = PredictiveEngine.loadData(
+        latent_csv, input_key_prefix=latent_key
+    )
+    device = get_torch_device(gpu_index, cpu_only)
+    # Moment propagation is only defined for the linear output layer
+    regressor, _ = PredictiveEngine.loadNetwork(
+        output_network_filename, n_latents, "linear", device
+    )
+
+    Console.info("Monte Carlo sampling (", num_samples, "samples per row)...")
+    start = timeit.default_timer()
+    mc_mean, mc_stdv, _ = PredictiveEngine.predict(
+        regressor, np_latent, num_samples, block_size=block_size, device=device
+    )
+    mc_time = timeit.default_timer() - start
+
+    Console.info("Moment propagation...")
+    start = timeit.default_timer()
+    mp_mean, mp_stdv, _ = PredictiveEngine.predict(
+        regressor,
+        np_latent,
+        num_samples,
+        block_size=block_size,
+        device=device,
+        uncertainty_mode="moments",
+    )
+    mp_time = timeit.default_timer() - start
+
+    mc_mean, mc_stdv = mc_mean * scale_factor, mc_stdv * scale_factor
+    mp_mean, mp_stdv = mp_mean * scale_factor, mp_stdv * scale_factor
+    n_rows = len(np_latent)
+
+    outputs = []
+    for i in range(mc_mean.shape[1]):
+        mean_diff = np.abs(mp_mean[:, i] - mc_mean[:, i])
+        stdv_diff = np.abs(mp_stdv[:, i] - mc_stdv[:, i])
+        outputs.append(
+            {
+                "output": i,
+                "mean_abs_diff_mean": float(np.mean(mean_diff)),
+                "max_abs_diff_mean": float(np.max(mean_diff)),
+                "mean_abs_diff_std": float(np.mean(stdv_diff)),
+                "max_abs_diff_std": float(np.max(stdv_diff)),
+                # relative to the average MC uncertainty
+                "relative_diff_std": float(
+                    np.mean(stdv_diff) / max(np.mean(mc_stdv[:, i]), 1e-12)
+                ),
+                "correlation_std": float(
+                    np.corrcoef(mp_stdv[:, i], mc_stdv[:, i])[0, 1]
+                ),
+                "mc_mean_std": float(np.mean(mc_stdv[:, i])),
+                "moments_mean_std": float(np.mean(mp_stdv[:, i])),
+                # Standard error of the MC mean: differences below this level are
+                # indistinguishable from the sampling noise
+                "mc_standard_error": float(
+                    np.mean(mc_stdv[:, i]) / np.sqrt(num_samples)
+                ),
+            }
+        )
+
+    report = {
+        "input_filename": latent_csv,
+        "network_filename": output_network_filename,
+        "num_rows": n_rows,
+        "num_samples": num_samples,
+        "mc_time_s": mc_time,
+        "moments_time_s": mp_time,
+        "mc_rows_per_s": n_rows / max(mc_time, 1e-12),
+        "moments_rows_per_s": n_rows / max(mp_time, 1e-12),
+        "speedup": mc_time / max(mp_time, 1e-12),
+        "outputs": outputs,
+    }
+
+    for entry in outputs:
+        Console.info(
+            "Output [",
+            entry["output"],
+            "] mean |diff| = {:.4g}".format(entry["mean_abs_diff_mean"]),
+            " std |diff| = {:.4g}".format(entry["mean_abs_diff_std"]),
+            " ({:.2%} of MC std)".format(entry["relative_diff_std"]),
+            " std correlation = {:.4f}".format(entry["correlation_std"]),
+        )
+    Console.info(
+        "MC: {:.2f} s | moments: {:.2f} s | speedup: {:.1f}x".format(
+            mc_time, mp_time, report["speedup"]
+        )
+    )
+    Console.info("Exporting report to: ", output_filename)
+    with open(output_filename, "w") as f:
+        yaml.dump(report, f, sort_keys=False)
+    return 0
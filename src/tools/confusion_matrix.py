@@ -2,13 +2,19 @@
 # Filename: valid_ce_loss_test_elbo0001_recon100.csv
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 import sys
 import argparse
 import os
 import yaml
 
+from bnn_inference.tools.table_io import read_table
+
+
+# Only the target_ and pred_ columns of the (CSV, Parquet or Arrow) table are loaded
+def is_used(col):
+    return col.startswith('target_') or col.startswith('pred_')
+
 
 # Create main (entry point)
 def main():
@@ -61,8 +67,8 @@ def main():
     if os.path.isfile(output_filename):
         print(warning_str, " File exists. Will overwrite", output_filename)
 
-    # Read CSV file
-    df = pd.read_csv(filename)
+    # Read CSV (or Parquet/Arrow) file
+    df = read_table(filename, columns=is_used)
 
     # the target (ground truth) labels are the columns starting with "target_"
     # the predicted labels are the columns starting with "pred_"